@@ -7,10 +7,95 @@ dbname="fhrs"
 # small_test = Rugby and Warwick, west_mids = West Midlands, full = All regions
 get_fhrs_mode="small_test"
 
+# fhrs source
+# api = download establishments from the FHRS API
+# files = read FHRS open data XML files (one per authority) from fhrs_files_dir
+fhrs_source="api"
+fhrs_files_dir="data/fhrs"
+
+# fhrs load mode
+# replace = recreate the FHRS tables and download all authorities
+# incremental = keep existing data and only replace that for authorities which
+#     have published new data since they were last loaded
+# upsert = as incremental, but only write establishments which are new or have
+#     changed, and delete those which are no longer in the data
+# resume = continue a 'replace' load which didn't finish, skipping the pages
+#     already written (see the fhrs_load_journal table for progress)
+fhrs_load_mode="replace"
+
+# max average number of requests per second to the FHRS API
+fhrs_requests_per_sec=10
+
+# number of minutes after which get_fhrs_data.py stops making API requests
+fhrs_deadline_mins=240
+
+# max number of pages of FHRS establishments to download at once
+fhrs_download_threads=4
+
+# max number of FHRS authorities to download at once while writing others
+fhrs_authority_threads=3
+
+# max number of downloaded pages of FHRS establishments waiting to be written
+fhrs_queue_size=20
+
+# load FHRS establishments into the database using COPY, one batch per page?
+# establishments which can't be loaded are appended to fhrs_reject_file
+fhrs_bulk_load=True
+fhrs_reject_file="data/fhrs-rejects.tsv"
+
+# directory in which to cache FHRS API responses ("" for no cache)
+# cached responses are used without revalidating them for fhrs_cache_ttl secs
+# and the least recently used are removed when the cache exceeds fhrs_cache_max_mb
+fhrs_cache_dir="data/fhrs-cache"
+fhrs_cache_ttl=72000
+fhrs_cache_max_mb=500
+
+# only use cached FHRS API responses e.g. to re-run after a failure?
+fhrs_cache_only=False
+
+# osm load mode
+# replace = recreate the OSM table
+# upsert = keep the existing table, only writing entities which are new or
+#     have changed and deleting those which are no longer in the data
+osm_load_mode="replace"
+
+# OSM entities which can't be loaded into the database are appended to this file
+osm_reject_file="data/osm-rejects.tsv"
+
+# Overpass API server to query if we're not using a planet extract
+overpass_url="http://overpass-api.de/api/interpreter"
+
+# size in degrees of the grid cells used to work out where FHRS establishments
+# are, so that only OSM data near them is downloaded or written (0 to use a
+# single bounding box around all the establishments instead), and the margin
+# in degrees around each cell which is also included
+coverage_cell_degrees=0.05
+coverage_margin_degrees=0.01
+
+# size in degrees of the tiles into which the area is split for querying
+# Overpass API (0 for a single query), and max number of tiles queried at once
+overpass_tile_degrees=0.5
+overpass_threads=2
+
+# have Overpass API return the centre of each way's bounding box rather than
+# all of its nodes? (much less data, but the centre of the bounding box is
+# used instead of the centroid of the way)
+overpass_center=False
+
 # do we want to use a filtered planet extract file (data/filtered.osm)
 # instead of querying using Overpass API?
 use_xml_file=False
 
+# directory in which to save the positions of the nodes in the filtered planet
+# extract, so that they can be reused until the file changes ("" to not save)
+osm_node_store_dir="data/osm-nodes"
+
+# do we want to read the planet extract file (input_pbf) directly using the
+# osmium module instead? (no need for osmosis or filter-osm.sh) The file is
+# read twice, first for the members of matching relations, as relations come
+# after the nodes and ways they contain
+use_pbf_file=False
+
 # path of pbf file if we're using a planet extract
 input_pbf="data/great-britain-latest.osm.pbf"
 
@@ -19,3 +104,23 @@ osmosis_bin="~/Downloads/osmosis-latest/bin/osmosis"
 
 # distance in metres to use when flagging up distant matches
 warning_distance_metres=500
+
+# work out which district each FHRS establishment and OSM entity is in as
+# it's written, rather than in a separate pass by process_data.py? District
+# boundaries are cached in district_cache_file
+tag_districts_on_ingest=True
+district_cache_file="data/districts.wkb"
+
+# number of database connections used at once when working out which
+# district each FHRS establishment and OSM entity is in, if this is done
+# in a separate pass
+district_threads=2
+
+# store the comparison views' rows, with indexes, rather than recalculating
+# them each time they're read? (much quicker to create output files, but the
+# views are snapshots which are only refreshed when process_data.py is run)
+materialise_views=False
+
+# max number of nearby FHRS establishments, in order of name similarity,
+# examined when suggesting a match for each OSM entity
+suggest_candidate_limit=10
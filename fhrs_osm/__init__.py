@@ -3,11 +3,1117 @@ import psycopg2
 from psycopg2.extras import DictCursor
 from collections import OrderedDict
 import urllib2
+import httplib
+import socket
+import urlparse
+import zlib
+import hashlib
+import json
+import random
+import re
+import math
+import multiprocessing
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
 import xml.etree.ElementTree
+import xml.etree.cElementTree
 from xml.sax.saxutils import escape
-from shapely.geometry import Polygon
-from shapely.geometry import MultiPoint
-from time import sleep
+import numpy
+import struct
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+try:
+    import osmium
+except ImportError:
+    osmium = None # only needed for reading PBF files (see OSMDataset.iter_pbf_elements)
+from time import sleep, time
+import sys
+import os
+import threading
+import Queue
+from cStringIO import StringIO
+
+
+def _thread_map(func, items, max_workers=4):
+    """Call func once for each item using a bounded pool of worker threads.
+    If any call raises an exception, no further items are started and the
+    first exception is re-raised once the running calls have finished.
+
+    func (function): function taking a single item as its argument
+    items (list): items to pass to func
+    max_workers (integer): max number of calls to run at once
+    Returns list of return values in the same order as items
+    """
+
+    results = [None] * len(items)
+    todo = Queue.Queue()
+    for i in range(len(items)):
+        todo.put(i)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = []
+    for i in range(max(1, min(max_workers, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+
+def _thread_imap(func, items, max_workers=4):
+    """Like _thread_map, but a generator which yields each return value in
+    order as soon as it is available. Workers only get ahead of the consumer
+    by up to max_workers items, so memory use stays bounded. If a call
+    raises an exception, no further items are started, and the exception
+    is re-raised once the values for all the earlier items have been
+    yielded. If the generator is closed early, the workers stop once their
+    current calls have finished.
+
+    func (function): function taking a single item as its argument
+    items (list): items to pass to func
+    max_workers (integer): max number of calls to run or hold at once
+    Yields return values in the same order as items
+    """
+
+    results = {} # (return value, exception info) keyed by position in items
+    done = threading.Condition()
+    slots = threading.Semaphore(max_workers)
+    stopped = threading.Event() # set when the consumer stops or a call fails
+    todo = Queue.Queue()
+    for i in range(len(items)):
+        todo.put(i)
+
+    def worker():
+        while True:
+            slots.acquire() # released when the consumer takes a result
+            if stopped.is_set():
+                return
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                slots.release()
+                return
+            try:
+                result = (func(items[i]), None)
+            except Exception:
+                result = (None, sys.exc_info())
+                stopped.set()
+            with done:
+                results[i] = result
+                done.notify_all()
+
+    for i in range(max(1, min(max_workers, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        # items are started in order, so every item before a failed one has
+        # been started and will have a result
+        for i in range(len(items)):
+            with done:
+                while i not in results:
+                    done.wait(1)
+                result, error = results.pop(i)
+            if error is not None:
+                exc_type, exc_value, exc_tb = error
+                raise exc_type, exc_value, exc_tb
+            slots.release()
+            yield result
+    finally:
+        # wake any workers waiting for a slot so that they can exit
+        stopped.set()
+        for i in range(max_workers):
+            slots.release()
+
+
+def _drop_view(connection, view_name):
+    """Drop a view or materialized view, if there is one with this name,
+    and any views which depend on it. (DROP VIEW fails for materialized
+    views, and vice versa.)
+
+    connection (object): database connection
+    view_name (string): name of view
+    """
+
+    cur = connection.cursor()
+    cur.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', (view_name,))
+    row = cur.fetchone()
+    if row is not None and row[0] == 'm':
+        cur.execute('DROP MATERIALIZED VIEW IF EXISTS ' + view_name + ' CASCADE')
+    else:
+        cur.execute('DROP VIEW IF EXISTS ' + view_name + ' CASCADE')
+    connection.commit()
+
+
+def _drop_column(connection, table, column):
+    """Drop a column from a table, if it exists, and commit
+
+    connection (object): database connection
+    table (string): name of table
+    column (string): name of column
+    """
+
+    cur = connection.cursor()
+    cur.execute('ALTER TABLE ' + table + ' DROP COLUMN IF EXISTS ' + column)
+    connection.commit()
+
+
+class StageCounter(object):
+    """A thread-safe counter of the work done by one stage of a pipeline,
+    used to report its throughput.
+
+    name (string): name of the stage e.g. 'download'
+    units (dict): running totals e.g. {'authorities': 3, 'pages': 12}
+    busy_secs (float): total time spent working (summed across threads)
+    """
+
+    def __init__(self, name):
+        """Constructor
+
+        name (string): name of the stage e.g. 'download'
+        """
+        self.name = name
+        self.units = OrderedDict()
+        self.busy_secs = 0.0
+        self.start_time = time()
+        self.lock = threading.Lock()
+
+    def add(self, busy_secs=0.0, **units):
+        """Add to the running totals for this stage
+
+        busy_secs (float): time spent doing this piece of work
+        units (integers): amount of work done e.g. pages=3
+        """
+        with self.lock:
+            self.busy_secs += busy_secs
+            for unit, amount in units.iteritems():
+                self.units[unit] = self.units.get(unit, 0) + amount
+
+    def summary(self):
+        """Return a one-line summary of the work done and the rate at which
+        it was done, based on wall-clock time since the counter was created.
+
+        Returns string
+        """
+        with self.lock:
+            elapsed = max(time() - self.start_time, 0.001)
+            parts = []
+            for unit, amount in self.units.iteritems():
+                parts.append('{} {} ({:.1f}/s)'.format(amount, unit, amount / elapsed))
+            return '{}: {} in {:.1f}s wall, {:.1f}s busy'.format(
+                self.name, ', '.join(parts), elapsed, self.busy_secs)
+
+
+class PooledResponse(object):
+    """A file-like HTTP response from an HTTPConnectionPool, which decodes
+    gzip/deflate content as it is read. Once the body has been read to the
+    end, the connection is returned to the pool for reuse.
+
+    status (integer): HTTP status code
+    reason (string): HTTP reason phrase
+    msg (object): response headers (mimetools.Message)
+    """
+
+    chunk_size = 16384
+
+    def __init__(self, pool, key, connection, response):
+        """Constructor
+
+        pool (object): HTTPConnectionPool the connection belongs to
+        key (tuple): pool key for the connection
+        connection (object): httplib connection the response was read from
+        response (object): httplib.HTTPResponse object
+        """
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.buf = ''
+        self.eof = False
+        if (response.getheader('content-encoding') or '').lower() in ('gzip', 'deflate'):
+            # 32 + MAX_WBITS = detect gzip or zlib header automatically
+            self.decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        else:
+            self.decoder = None
+
+    def getheader(self, name, default=None):
+        """Return the value of a response header"""
+        return self.response.getheader(name, default)
+
+    def read(self, size=-1):
+        """Read and decode up to size bytes of the body, or all of it if size
+        is negative
+
+        Returns string
+        """
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            raw = self.response.read(self.chunk_size)
+            self.pool.count(wire_bytes=len(raw))
+            if raw == '':
+                self.eof = True
+                if self.decoder is not None:
+                    self.buf += self.decoder.flush()
+                self.pool.release(self.key, self.connection, self.response)
+                self.connection = None
+            elif self.decoder is not None:
+                self.buf += self.decoder.decompress(raw)
+            else:
+                self.buf += raw
+
+        if size < 0:
+            data, self.buf = self.buf, ''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        self.pool.count(body_bytes=len(data))
+        return data
+
+    def close(self):
+        """Close the response. If the body hasn't been read to the end, the
+        connection can't be reused so it is closed too.
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.eof = True
+
+
+class HTTPConnectionPool(object):
+    """A thread-safe pool of persistent HTTP(S) connections, so that many
+    requests to the same host don't each need a new TCP/TLS handshake.
+    Responses are requested with gzip/deflate compression. Counts of bytes
+    transferred and time waited for responses are kept so that the effect
+    can be measured.
+
+    max_idle (integer): max number of idle connections kept per host
+    timeout (numeric): socket timeout in seconds
+    max_redirects (integer): max number of redirects to follow
+    """
+
+    def __init__(self, max_idle=8, timeout=60, max_redirects=5):
+        """Constructor
+
+        max_idle (integer): max number of idle connections kept per host
+        timeout (numeric): socket timeout in seconds
+        max_redirects (integer): max number of redirects to follow
+        """
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.counts = OrderedDict([('requests', 0), ('new_connections', 0),
+                                   ('wire_bytes', 0), ('body_bytes', 0),
+                                   ('latency_secs', 0.0)])
+
+    def count(self, **amounts):
+        """Add to the pool's counts e.g. count(wire_bytes=100)"""
+        with self.lock:
+            for name, amount in amounts.iteritems():
+                self.counts[name] += amount
+
+    def get_counts(self):
+        """Return a copy of the pool's counts, including the mean latency
+        (time from sending a request to receiving the response headers) and
+        the ratio of decoded to transferred bytes.
+
+        Returns dict
+        """
+        with self.lock:
+            counts = OrderedDict(self.counts)
+        counts['mean_latency_secs'] = counts['latency_secs'] / max(counts['requests'], 1)
+        counts['compression_ratio'] = float(counts['body_bytes']) / max(counts['wire_bytes'], 1)
+        return counts
+
+    def acquire(self, key):
+        """Return an idle connection for key, or a new one if there are none
+
+        key (tuple): (scheme, host, port)
+        Returns tuple (connection, reused)
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.counts['new_connections'] += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection, response):
+        """Return a connection to the pool once its response has been read,
+        unless the server has asked for it to be closed
+
+        key (tuple): (scheme, host, port)
+        connection (object): httplib connection
+        response (object): httplib.HTTPResponse which has been read to the end
+        """
+        if response.will_close:
+            connection.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, url, headers=[]):
+        """Make a GET request, following any redirects
+
+        url (string): URL to request
+        headers (list of tuples): headers to add to HTTP request
+        Returns PooledResponse object
+        Raises urllib2.HTTPError if the response status is 400 or above
+        """
+        for redirect in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            key = (parts.scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            request_headers = {'Accept-Encoding': 'gzip, deflate'}
+            for header, content in headers:
+                request_headers[header] = content
+
+            # an idle connection may have been closed by the server, in which
+            # case try again once with a new connection
+            while True:
+                connection, reused = self.acquire(key)
+                start = time()
+                try:
+                    connection.request('GET', path, headers=request_headers)
+                    response = connection.getresponse()
+                except (socket.error, httplib.HTTPException):
+                    connection.close()
+                    if reused:
+                        continue
+                    raise
+                break
+            self.count(requests=1, latency_secs=time() - start)
+            pooled = PooledResponse(self, key, connection, response)
+
+            if pooled.status in (301, 302, 303, 307, 308) and pooled.getheader('location'):
+                pooled.read()
+                url = urlparse.urljoin(url, pooled.getheader('location'))
+                continue
+            if pooled.status >= 400:
+                pooled.read()
+                raise urllib2.HTTPError(url, pooled.status, pooled.reason, pooled.msg, None)
+            return pooled
+
+        raise urllib2.HTTPError(url, pooled.status, 'Too many redirects', pooled.msg, None)
+
+
+class ResponseCache(object):
+    """A size-bounded on-disk cache of API responses. For each endpoint the
+    body is stored along with its ETag/Last-Modified headers and the time it
+    was fetched, so that stale entries can be revalidated with a
+    conditional request. When the cache grows beyond max_bytes, the least
+    recently used entries are removed.
+
+    directory (string): directory in which to store cached responses
+    ttl (numeric): number of seconds for which a response is used without
+        revalidating it
+    max_bytes (integer): max total size of cached response bodies
+    offline (boolean): only use cached responses, never the network?
+    """
+
+    def __init__(self, directory, ttl=72000, max_bytes=500*1024*1024, offline=False):
+        """Constructor
+
+        directory (string): directory in which to store cached responses
+        ttl (numeric): number of seconds for which a response is used
+            without revalidating it
+        max_bytes (integer): max total size of cached response bodies
+        offline (boolean): only use cached responses, never the network?
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.total_bytes = None # running total, found by evict's first scan
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, endpoint, extension):
+        """Return the path of a cache file for an endpoint
+
+        endpoint (string): endpoint part of URL
+        extension (string): '.xml' for the body or '.json' for metadata
+        Returns string
+        """
+        return os.path.join(self.directory,
+                            hashlib.sha1(endpoint).hexdigest() + extension)
+
+    def get_temp_path(self, path):
+        """Return the path of a temporary file to write before renaming it
+        to path, so that readers never see a partially written file
+
+        path (string): path of cache file
+        Returns string
+        """
+        return path + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident)
+
+    def get(self, endpoint):
+        """Return the cached response for an endpoint, if there is one. The
+        body is opened rather than read, so it can be streamed; the file
+        must be closed by the caller.
+
+        endpoint (string): endpoint part of URL
+        Returns dict with keys file, etag, last_modified, fetched and fresh,
+            or None if the endpoint isn't cached
+        """
+        try:
+            f = open(self.get_path(endpoint, '.json'))
+            entry = json.load(f)
+            f.close()
+            entry['file'] = open(self.get_path(endpoint, '.xml'), 'rb')
+            # mark the entry as recently used for eviction purposes
+            os.utime(self.get_path(endpoint, '.xml'), None)
+        except (IOError, OSError, ValueError):
+            return None
+        entry['fresh'] = time() - entry['fetched'] < self.ttl
+        return entry
+
+    def write_entry(self, endpoint, entry):
+        """Write the metadata of a cached response
+
+        endpoint (string): endpoint part of URL
+        entry (dict): metadata with keys endpoint, etag, last_modified and
+            fetched
+        """
+        path = self.get_path(endpoint, '.json')
+        temp_path = self.get_temp_path(path)
+        f = open(temp_path, 'w')
+        json.dump(entry, f)
+        f.close()
+        os.rename(temp_path, path)
+
+    def put(self, endpoint, body_path, etag=None, last_modified=None):
+        """Store a response whose body has been written to a temporary file
+        (see get_temp_path), then evict old entries if the cache is too big.
+        A running total of the size of the cache is kept, so the directory
+        is only scanned when the total goes over max_bytes.
+
+        endpoint (string): endpoint part of URL
+        body_path (string): temporary file containing response body, which
+            is renamed into the cache
+        etag (string): value of ETag response header
+        last_modified (string): value of Last-Modified response header
+        """
+        path = self.get_path(endpoint, '.xml')
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        size = os.path.getsize(body_path)
+        os.rename(body_path, path)
+        self.write_entry(endpoint, {'endpoint': endpoint, 'etag': etag,
+                                    'last_modified': last_modified, 'fetched': time()})
+
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += size - old_size
+            full = self.total_bytes is None or self.total_bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    def touch(self, endpoint):
+        """Reset the fetch time of a cached response after it has been
+        revalidated
+
+        endpoint (string): endpoint part of URL
+        """
+        f = open(self.get_path(endpoint, '.json'))
+        entry = json.load(f)
+        f.close()
+        entry['fetched'] = time()
+        self.write_entry(endpoint, entry)
+
+    def evict(self):
+        """Remove the least recently used entries until the total size of
+        cached bodies is no more than max_bytes
+        """
+        with self.lock:
+            entries = []
+            total = 0
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.xml'):
+                    continue
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                for remove_path in (path, path[:-len('.xml')] + '.json'):
+                    try:
+                        os.remove(remove_path)
+                    except OSError:
+                        pass
+                total -= size
+            self.total_bytes = total
+
+
+class CachingResponse(object):
+    """A file-like HTTP response which copies the body to a temporary file
+    as it is read, so that it can be streamed and cached at the same time.
+    The copy is only added to the cache once the body has been read to the
+    end, so a partly read response is never cached.
+    """
+
+    def __init__(self, cache, endpoint, response):
+        """Constructor
+
+        cache (object): ResponseCache to add the response to
+        endpoint (string): endpoint part of URL
+        response (object): file-like HTTP response e.g. PooledResponse
+        """
+        self.cache = cache
+        self.endpoint = endpoint
+        self.response = response
+        self.etag = response.getheader('etag')
+        self.last_modified = response.getheader('last-modified')
+        self.temp_path = cache.get_temp_path(cache.get_path(endpoint, '.xml'))
+        self.temp_file = open(self.temp_path, 'wb')
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body, or all of it if size is
+        negative
+
+        Returns string
+        """
+        data = self.response.read(size)
+        if self.temp_file is not None:
+            self.temp_file.write(data)
+            if size < 0 or (size > 0 and data == ''):
+                # end of body, so add it to the cache
+                self.temp_file.close()
+                self.temp_file = None
+                self.cache.put(self.endpoint, self.temp_path, etag=self.etag,
+                               last_modified=self.last_modified)
+        return data
+
+    def close(self):
+        """Close the response, discarding the copy of the body if it hasn't
+        been read to the end
+        """
+        self.response.close()
+        if self.temp_file is not None:
+            self.temp_file.close()
+            self.temp_file = None
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+
+
+class FHRSAPIError(RuntimeError):
+    """Raised when a request to the FHRS API is refused without being
+    attempted, because its circuit breaker is open or the run's deadline
+    has passed.
+    """
+    pass
+
+
+class FHRSDeadlineError(FHRSAPIError):
+    """Raised when a request to the FHRS API is given up because the run's
+    deadline has passed, or would pass before it could be retried.
+    """
+    pass
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket rate limiter, which allows bursts of up to
+    capacity requests and an average of rate requests per second.
+
+    rate (numeric): tokens added per second
+    capacity (numeric): max number of tokens held
+    """
+
+    def __init__(self, rate=10, capacity=10):
+        """Constructor
+
+        rate (numeric): tokens added per second
+        capacity (numeric): max number of tokens held
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """Wait until a token is available and take it
+
+        deadline (numeric): if supplied, time (secs since epoch) after which
+            we give up waiting
+        Raises FHRSDeadlineError if a token wouldn't be available before deadline
+        """
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise FHRSDeadlineError("Deadline passed while waiting to make a request")
+            sleep(wait)
+
+
+class CircuitBreaker(object):
+    """A thread-safe set of circuit breakers, one per key (e.g. per
+    authority). After failure_threshold consecutive failures for a key, its
+    circuit opens and requests for that key fail immediately until
+    reset_secs have passed, when a single trial request is allowed.
+
+    failure_threshold (integer): consecutive failures which open a circuit
+    reset_secs (numeric): time after which an open circuit allows a trial
+    """
+
+    def __init__(self, failure_threshold=3, reset_secs=300):
+        """Constructor
+
+        failure_threshold (integer): consecutive failures which open a circuit
+        reset_secs (numeric): time after which an open circuit allows a trial
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self.failures = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def check(self, key):
+        """Raise FHRSAPIError if the circuit for key is open
+
+        key (string): circuit key
+        """
+        with self.lock:
+            opened = self.opened.get(key)
+            if opened is None:
+                return
+            if time() - opened < self.reset_secs:
+                raise FHRSAPIError("Circuit breaker open for " + key)
+            # allow a trial request, re-opening if it fails
+            self.failures[key] = self.failure_threshold - 1
+            del self.opened[key]
+
+    def record_success(self, key):
+        """Close the circuit for key
+
+        key (string): circuit key
+        """
+        with self.lock:
+            self.failures.pop(key, None)
+            self.opened.pop(key, None)
+
+    def record_failure(self, key):
+        """Count a failure for key, opening its circuit if there have been
+        failure_threshold consecutive failures
+
+        key (string): circuit key
+        Returns True if the circuit is now open
+        """
+        with self.lock:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            if self.failures[key] >= self.failure_threshold:
+                self.opened[key] = time()
+                return True
+            return False
+
+
+class BulkLoader(object):
+    """A class which loads batches of rows into a database table using COPY
+    rather than one INSERT statement per row. Each batch is copied into a
+    temporary staging table and then inserted into the target table in a
+    single statement, building the geography column on the server from lon
+    and lat columns. If a batch fails, its rows are inserted one at a time
+    so that bad rows can be diverted to a reject file without losing the
+    rest of the batch.
+
+    If upsert_key is given, rows which already exist in the target table are
+    updated rather than inserted, and the keys of all the rows loaded
+    (including rejected ones, whose existing rows are kept) are recorded so
+    that rows missing from the new data can be deleted using
+    delete_unseen. If hash_column is also given, a hash of each row's
+    content is stored with it and existing rows whose content hasn't
+    changed aren't updated at all.
+
+    connection (object): database connection
+    table_name (string): name of target database table
+    columns (list of strings): names of the values in each row, which may
+        include 'lon' and 'lat' to be combined into the geography column
+    geog_column (string): name of geography column in the target table
+    reject_filename (string): file to which rejected rows are appended
+    upsert_key (list of strings): names of the columns in the target
+        table's primary key
+    hash_column (string): name of content hash column in the target table
+    batch_size (integer): number of rows buffered by add before they are
+        loaded
+    """
+
+    def __init__(self, connection, table_name, columns, geog_column='geog',
+                 reject_filename=None, upsert_key=None, hash_column=None,
+                 batch_size=10000):
+        """Constructor
+
+        connection (object): database connection
+        table_name (string): name of target database table
+        columns (list of strings): names of the values in each row
+        geog_column (string): name of geography column in the target table
+        reject_filename (string): file to which rejected rows are appended
+        upsert_key (list of strings): names of primary key columns, if rows
+            which already exist are to be updated
+        hash_column (string): name of content hash column in the target table
+        batch_size (integer): number of rows buffered before they are loaded
+        """
+        self.connection = connection
+        self.table_name = table_name
+        self.columns = columns
+        self.geog_column = geog_column
+        self.reject_filename = reject_filename
+        self.upsert_key = upsert_key
+        self.hash_column = hash_column
+        self.stage_name = 'stage_' + table_name
+        self.seen_name = 'seen_' + table_name
+        self.batch_size = batch_size
+        self.buffer = []
+        self.loaded = 0
+        self.rejected = 0
+
+        # the columns loaded include the content hash, if there is one
+        self.load_columns = list(columns)
+        if hash_column is not None:
+            self.load_columns.append(hash_column)
+
+        # N.B. column names case sensitive because surrounded by ""
+        self.table_columns = []
+        self.select_columns = []
+        for column in self.load_columns:
+            if column not in ('lon', 'lat'):
+                self.table_columns.append('"' + column + '"')
+                self.select_columns.append('"' + column + '"')
+        if 'lon' in columns and 'lat' in columns:
+            self.table_columns.append(geog_column)
+            self.select_columns.append('CASE WHEN lon IS NULL OR lat IS NULL THEN NULL\n' +
+                                       'ELSE ST_SetSRID(ST_MakePoint(lon, lat), 4326)::geography\n' +
+                                       'END')
+
+    def create_stage(self):
+        """Create the temporary staging table if it doesn't already exist. It
+        has the same columns as the target table plus lon and lat columns.
+        If upserting, also create the temporary table of keys seen. Doesn't
+        commit, so that a batch can be part of a larger transaction.
+        """
+
+        sql = 'CREATE TEMP TABLE IF NOT EXISTS ' + self.stage_name + ' AS\n'
+        if 'lon' in self.columns and 'lat' in self.columns:
+            sql += ('SELECT *, NULL::DOUBLE PRECISION AS lon,\n' +
+                    'NULL::DOUBLE PRECISION AS lat\n')
+        else:
+            sql += 'SELECT *\n'
+        sql += 'FROM ' + self.table_name + ' WITH NO DATA'
+        cur = self.connection.cursor()
+        cur.execute(sql)
+
+        if self.upsert_key is not None:
+            cur.execute('CREATE TEMP TABLE IF NOT EXISTS ' + self.seen_name + ' AS\n' +
+                        'SELECT "' + '", "'.join(self.upsert_key) + '"\n' +
+                        'FROM ' + self.table_name + ' WITH NO DATA')
+
+    def add_hash(self, row):
+        """Return the row with the hash of its content appended, if the
+        target table has a content hash column
+
+        row (tuple): row of values in the same order as columns
+        Returns tuple
+        """
+        if self.hash_column is None:
+            return row
+        content_hash = hashlib.md5(self.copy_data([row]).getvalue()).hexdigest()
+        return row + (content_hash,)
+
+    def get_conflict_sql(self):
+        """Return the ON CONFLICT clause used when inserting rows, which
+        updates existing rows whose content hash (if any) has changed
+
+        Returns string
+        """
+        if self.upsert_key is None:
+            return ''
+        key_columns = ['"' + column + '"' for column in self.upsert_key]
+        updates = []
+        for column in self.table_columns:
+            if column not in key_columns:
+                updates.append(column + ' = EXCLUDED.' + column)
+        sql = ('\nON CONFLICT (' + ', '.join(key_columns) + ') DO UPDATE\n' +
+               'SET ' + ', '.join(updates))
+        if self.hash_column is not None:
+            sql += ('\nWHERE target."' + self.hash_column + '"' +
+                    ' IS DISTINCT FROM EXCLUDED."' + self.hash_column + '"')
+        return sql
+
+    def get_insert_sql(self):
+        """Return the start of the statement used to insert rows
+
+        Returns string
+        """
+        sql = 'INSERT INTO ' + self.table_name
+        if self.upsert_key is not None:
+            sql += ' AS target'
+        return sql + ' (' + ', '.join(self.table_columns) + ')\n'
+
+    def delete_unseen(self, where=None, values=()):
+        """Delete rows from the target table whose keys haven't been loaded
+        since the last call, then forget the keys seen. Doesn't commit.
+
+        where (string): SQL condition restricting which rows of the target
+            table may be deleted e.g. those for a particular area
+        values (tuple): values for any placeholders in where
+        Returns number of rows deleted
+        """
+        self.create_stage()
+        conditions = []
+        for column in self.upsert_key:
+            conditions.append('seen."' + column + '" = target."' + column + '"')
+        sql = ('DELETE FROM ' + self.table_name + ' AS target\n' +
+               'WHERE NOT EXISTS (\n' +
+               '    SELECT 1 FROM ' + self.seen_name + ' AS seen\n' +
+               '    WHERE ' + ' AND '.join(conditions) + ')')
+        if where is not None:
+            sql += '\nAND (' + where + ')'
+        cur = self.connection.cursor()
+        cur.execute(sql, values)
+        deleted = cur.rowcount
+        cur.execute('TRUNCATE ' + self.seen_name)
+        return deleted
+
+    def copy_data(self, rows):
+        """Return a file-like object containing rows in the text format
+        expected by COPY
+
+        rows (list of tuples): rows of values in the same order as columns
+        Returns file-like object
+        """
+
+        buf = StringIO()
+        for row in rows:
+            fields = []
+            for value in row:
+                if value is None:
+                    fields.append('\\N')
+                    continue
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                elif isinstance(value, float):
+                    # str only gives 12 significant figures
+                    value = repr(value)
+                else:
+                    value = str(value)
+                fields.append(value.replace('\\', '\\\\').replace('\t', '\\t')
+                                   .replace('\n', '\\n').replace('\r', '\\r'))
+            buf.write('\t'.join(fields) + '\n')
+        buf.seek(0)
+        return buf
+
+    def add(self, rows):
+        """Add rows to the buffer, loading and committing the buffered rows
+        once there are at least batch_size of them
+
+        rows (list of tuples): rows of values in the same order as columns
+        """
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self, commit=True):
+        """Load any buffered rows
+
+        commit (boolean): commit the transaction once the rows are loaded?
+        Returns number of rows loaded
+        """
+        rows = self.buffer
+        self.buffer = []
+        return self.load(rows, commit=commit)
+
+    def load(self, rows, commit=True):
+        """Load a batch of rows into the target table
+
+        rows (list of tuples): rows of values in the same order as columns
+        commit (boolean): commit the transaction once the batch is loaded?
+        Returns number of rows inserted or updated (not including those
+            which were unchanged, if upserting)
+        """
+
+        if len(rows) == 0:
+            return 0
+
+        self.create_stage()
+        cur = self.connection.cursor()
+        cur.execute('SAVEPOINT bulk_load')
+        try:
+            cur.copy_expert('COPY ' + self.stage_name +
+                            ' ("' + '", "'.join(self.load_columns) + '") FROM STDIN',
+                            self.copy_data([self.add_hash(row) for row in rows]))
+            select = 'SELECT '
+            order = ''
+            if self.upsert_key is not None:
+                # a row can only be updated once per statement, so if a key
+                # appears more than once the last row staged wins (ctid is in
+                # the order rows were copied, as the stage is truncated after
+                # each batch)
+                key_columns = '"' + '", "'.join(self.upsert_key) + '"'
+                select += 'DISTINCT ON (' + key_columns + ') '
+                order = '\nORDER BY ' + key_columns + ', ctid DESC'
+            cur.execute(self.get_insert_sql() +
+                        select + ', '.join(self.select_columns) + '\n' +
+                        'FROM ' + self.stage_name + order +
+                        self.get_conflict_sql())
+            # rows whose content hasn't changed aren't counted
+            loaded = cur.rowcount
+            if self.upsert_key is not None:
+                cur.execute('INSERT INTO ' + self.seen_name + '\n' +
+                            'SELECT DISTINCT "' + '", "'.join(self.upsert_key) + '"\n' +
+                            'FROM ' + self.stage_name)
+            cur.execute('TRUNCATE ' + self.stage_name)
+            cur.execute('RELEASE SAVEPOINT bulk_load')
+            self.loaded += loaded
+        except (psycopg2.DataError, psycopg2.IntegrityError):
+            # fall back to inserting rows one at a time to isolate bad rows
+            cur.execute('ROLLBACK TO SAVEPOINT bulk_load')
+            loaded = self.load_rows_singly(rows)
+
+        if commit:
+            self.connection.commit()
+        return loaded
+
+    def load_rows_singly(self, rows):
+        """Insert rows one at a time, each within its own savepoint, writing
+        any rows which can't be inserted to the reject file. Doesn't commit.
+
+        rows (list of tuples): rows of values in the same order as columns
+        Returns number of rows inserted or updated
+        """
+
+        placeholders = []
+        for column in self.load_columns:
+            if column not in ('lon', 'lat'):
+                placeholders.append('%s')
+        if 'lon' in self.columns and 'lat' in self.columns:
+            lon_idx = self.columns.index('lon')
+            lat_idx = self.columns.index('lat')
+            placeholders.append('CASE WHEN %s IS NULL OR %s IS NULL THEN NULL\n' +
+                                'ELSE ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography\n' +
+                                'END')
+        else:
+            lon_idx = lat_idx = None
+        sql = (self.get_insert_sql() +
+               'VALUES (' + ', '.join(placeholders) + ')' +
+               self.get_conflict_sql())
+
+        if self.upsert_key is not None:
+            self.create_stage()
+            key_idx = [self.columns.index(column) for column in self.upsert_key]
+            seen_sql = ('INSERT INTO ' + self.seen_name +
+                        ' VALUES (' + ', '.join(['%s'] * len(key_idx)) + ')')
+
+        cur = self.connection.cursor()
+        loaded = 0
+        for row in rows:
+            hashed_row = self.add_hash(row)
+            values = []
+            for i in range(len(self.load_columns)):
+                if i != lon_idx and i != lat_idx:
+                    values.append(hashed_row[i])
+            if lon_idx is not None:
+                lon = row[lon_idx]
+                lat = row[lat_idx]
+                values.extend([lon, lat, lon, lat])
+            cur.execute('SAVEPOINT bulk_load_row')
+            try:
+                cur.execute(sql, tuple(values))
+            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                cur.execute('ROLLBACK TO SAVEPOINT bulk_load_row')
+                self.reject(row, e)
+            else:
+                # no row is affected if its content hasn't changed
+                loaded += cur.rowcount
+                cur.execute('RELEASE SAVEPOINT bulk_load_row')
+            if self.upsert_key is not None:
+                # record the key even if the row was rejected, so that
+                # delete_unseen keeps any existing row rather than deleting
+                # it (unless the key itself is invalid)
+                cur.execute('SAVEPOINT bulk_load_row')
+                try:
+                    cur.execute(seen_sql, tuple([row[i] for i in key_idx]))
+                except psycopg2.DataError:
+                    cur.execute('ROLLBACK TO SAVEPOINT bulk_load_row')
+                else:
+                    cur.execute('RELEASE SAVEPOINT bulk_load_row')
+        self.loaded += loaded
+        return loaded
+
+    def reject(self, row, error):
+        """Append a row which couldn't be loaded, together with the reason, to
+        the reject file. If there is no reject file, print them instead.
+
+        row (tuple): row of values
+        error (object): exception raised when trying to load the row
+        """
+
+        self.rejected += 1
+        reason = ' '.join(str(error).split())
+        if self.reject_filename is None:
+            print "\nCouldn't insert the following data into " + self.table_name + ":"
+            print row
+            print "The reason given was:"
+            print reason
+            print "Continuing..."
+            return
+
+        directory = os.path.dirname(self.reject_filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(self.reject_filename, 'a')
+        f.write(self.copy_data([row + (reason,)]).getvalue())
+        f.close()
 
 
 class Database(object):
@@ -37,108 +1143,203 @@ class Database(object):
         return self.connection
 
     def add_fhrs_districts(self, fhrs_table='fhrs_establishments',
-                           districts_table='districts', district_id_col='gid'):
+                           districts_table='districts', district_id_col='gid',
+                           max_workers=1, chunks=8, pieces_table='district_pieces'):
         """(Re-)add district_id columns to FHRS establishments table and fill
         with the ID of the district in which the FHRS establishment is located.
+        (See update_districts)
+        """
+
+        return self.update_districts(table=fhrs_table, key_column='"FHRSID"',
+                                     districts_table=districts_table,
+                                     district_id_col=district_id_col,
+                                     max_workers=max_workers, chunks=chunks,
+                                     pieces_table=pieces_table)
+
+    def add_osm_districts(self, osm_table='osm', districts_table='districts',
+                          district_id_col='gid', max_workers=1, chunks=8,
+                          pieces_table='district_pieces'):
+        """(Re-)add district_id columns to OSM table and fill with the ID of
+        the district in which the OSM entity is located. (See update_districts)
+        """
+
+        return self.update_districts(table=osm_table, key_column='id',
+                                     districts_table=districts_table,
+                                     district_id_col=district_id_col,
+                                     max_workers=max_workers, chunks=chunks,
+                                     pieces_table=pieces_table)
+
+    def create_district_pieces(self, districts_table='districts', district_id_col='gid',
+                               pieces_table='district_pieces', max_vertices=256):
+        """(Re)create a lookup table of districts split into small pieces
+        using ST_Subdivide, with a spatial index. Testing whether a point is
+        within one of these pieces is much quicker than testing against the
+        original boundary, which can have tens of thousands of vertices. The
+        original districts table is still used for boundary output.
+
+        districts_table (string): name of table of district boundaries
+        district_id_col (string): name of district ID column
+        pieces_table (string): name of table to create
+        max_vertices (integer): max number of vertices in each piece
         """
 
         cur = self.connection.cursor()
+        cur.execute('DROP TABLE IF EXISTS ' + pieces_table)
+        cur.execute('CREATE TABLE ' + pieces_table + ' AS\n' +
+                    'SELECT ' + district_id_col + ' AS district_id,\n' +
+                    'ST_Subdivide(geom, %s) AS geom\n' +
+                    'FROM ' + districts_table, (max_vertices,))
+        cur.execute('CREATE INDEX ' + pieces_table + '_geom_idx\n' +
+                    'ON ' + pieces_table + ' USING GIST (geom)')
+        cur.execute('CREATE INDEX ON ' + pieces_table + ' (district_id)')
+        cur.execute('ANALYZE ' + pieces_table)
+        self.connection.commit()
 
-        # (re-)add column to FHRS establishments table
-        try:
-            cur.execute('ALTER TABLE ' + fhrs_table + '\n' +
-                        'DROP COLUMN IF EXISTS district_id CASCADE\n')
-            cur.execute('ALTER TABLE ' + fhrs_table + '\n' +
-                        'ADD COLUMN district_id SMALLINT\n'
-                        'REFERENCES ' + districts_table + '(' + district_id_col + ')')
-        except psycopg2.ProgrammingError:
-            self.connection.rollback()
-            print "Could not drop or add district_id column to table " + fhrs_table + "."
-            print ("Does the " + districts_table + " table exist and contain the " +
-                   district_id_col + " column?")
-            return False
-        # N.B. not committed yet in case next stage fails
-
-        # get matching district ID for each establishment
-        sql = ('SELECT "FHRSID", ' + district_id_col + ' as dist_id ' +
-               'FROM ' + fhrs_table + ' fhrs\n' +
-               'LEFT JOIN ' + districts_table + ' dist\n'
-               'ON ST_Contains(dist.geom, fhrs.geog::geometry)\n' +
-               'WHERE fhrs.geog IS NOT NULL')
-        cur.execute(sql)
+    def update_districts(self, table, key_column, districts_table='districts',
+                         district_id_col='gid', max_workers=1, chunks=8,
+                         pieces_table='district_pieces'):
+        """(Re-)add district_id column to a table of points and fill it with
+        the ID of the district in which each point is located (the lowest
+        ID, for a point on the boundary between districts). This is done by
+        UPDATE statements, so the spatial join stays within the database, using the subdivided districts in pieces_table (which is
+        created if it doesn't exist, see create_district_pieces). The table
+        is split into chunks of roughly equal numbers of rows by key_column,
+        which can be updated at once using several database connections.
+        The IDs are written to a new column, which only replaces any
+        existing district_id column once every chunk has been updated, so
+        a failure leaves the table as it was.
+
+        table (string): name of table with geog column
+        key_column (string): indexed column by which to split the table
+            (quoted if necessary)
+        districts_table (string): name of table of district boundaries
+        district_id_col (string): name of district ID column
+        max_workers (integer): max number of connections updating at once
+        chunks (integer): number of chunks into which to split the table
+        pieces_table (string): name of table of subdivided districts
+        Returns boolean: True if successful
+        """
+
+        cur = self.connection.cursor()
 
-        # update each FHRS establishment with its district ID
-        for est in cur.fetchall():
-            fhrsid, dist_id = est
-            sql = ('UPDATE ' + fhrs_table + ' SET district_id = %s\n'
-                   'WHERE "FHRSID" = %s')
-            values = (dist_id, fhrsid)
+        cur.execute('SELECT to_regclass(%s)', (pieces_table,))
+        if cur.fetchone()[0] is None:
+            print "Creating " + pieces_table + " table from " + districts_table
             try:
-                cur.execute(sql, values)
+                self.create_district_pieces(districts_table=districts_table,
+                                            district_id_col=district_id_col,
+                                            pieces_table=pieces_table)
             except psycopg2.ProgrammingError:
                 self.connection.rollback()
-                print "Couldn't update district_id column in " + fhrs_table + " table."
-                print "SQL statement and values for last attempted execute:"
-                print sql, values
+                print "Could not create " + pieces_table + " table."
+                print ("Does the " + districts_table + " table exist and contain the " +
+                       district_id_col + " column?")
                 return False
 
-        # create index to speed up comparison with OSM district_ids
-        cur.execute('CREATE INDEX ON ' + fhrs_table + ' (district_id);')
-
+        # add new column alongside any existing district_id column
+        try:
+            cur.execute('ALTER TABLE ' + table + '\n' +
+                        'DROP COLUMN IF EXISTS district_id_new\n')
+            cur.execute('ALTER TABLE ' + table + '\n' +
+                        'ADD COLUMN district_id_new SMALLINT')
+        except psycopg2.ProgrammingError:
+            self.connection.rollback()
+            print "Could not add district_id_new column to table " + table + "."
+            return False
+        # committed so that other connections can update the new column
         self.connection.commit()
-        return True
-
-    def add_osm_districts(self, osm_table='osm', districts_table='districts',
-                          district_id_col='gid'):
-        """(Re-)add district_id columns to OSM table and fill with the ID of
-        the district in which the OSM entity is located.
-        """
 
-        cur = self.connection.cursor()
+        # find upper bound of each chunk of key values
+        sql = ('SELECT max(key) FROM (\n' +
+               '    SELECT ' + key_column + ' AS key,\n' +
+               '    ntile(%s) OVER (ORDER BY ' + key_column + ') AS chunk\n' +
+               '    FROM ' + table + '\n' +
+               '    WHERE geog IS NOT NULL\n' +
+               ') AS keys\n' +
+               'GROUP BY chunk ORDER BY 1')
+        cur.execute(sql, (max(1, chunks),))
+        bounds = [None] + [row[0] for row in cur.fetchall()]
+        ranges = zip(bounds[:-1], bounds[1:])
+
+        # N.B. ST_Intersects rather than ST_Contains, so that points on the
+        # edges between pieces of the same district are included. A point on
+        # the boundary between two districts gets the one with the lowest ID
+        sql = ('UPDATE ' + table + ' AS t SET district_id_new = (\n' +
+               '    SELECT min(dist.district_id) FROM ' + pieces_table + ' AS dist\n' +
+               '    WHERE ST_Intersects(dist.geom, t.geog::geometry))\n' +
+               'WHERE t.geog IS NOT NULL\n' +
+               'AND t.' + key_column + ' <= %s')
+
+        def update_chunk(key_range):
+            low, high = key_range
+            if low is None:
+                chunk_sql = sql
+                values = (high,)
+            else:
+                chunk_sql = sql + ' AND t.' + key_column + ' > %s'
+                values = (high, low)
+            if len(ranges) == 1:
+                chunk_connection = self.connection
+            else:
+                chunk_connection = psycopg2.connect(database=self.dbname)
+            try:
+                chunk_cur = chunk_connection.cursor()
+                chunk_cur.execute(chunk_sql, values)
+                updated = chunk_cur.rowcount
+                chunk_connection.commit()
+            finally:
+                if chunk_connection is not self.connection:
+                    chunk_connection.close()
+            return updated
+
+        updated = 0
+        try:
+            for i, chunk_updated in enumerate(_thread_imap(update_chunk, ranges, max_workers)):
+                updated += chunk_updated
+                print ("Updated district_id in " + table + " for chunk " + str(i + 1) +
+                       " of " + str(len(ranges)) + " (" + str(updated) + " rows so far)")
+        except psycopg2.Error as e:
+            self.connection.rollback()
+            print "Couldn't update district_id column in " + table + " table."
+            print "SQL statement for last attempted update:"
+            print sql
+            print e
+            _drop_column(self.connection, table, 'district_id_new')
+            return False
 
-        # (re-)add column to OSM table
+        # swap the new column for the old one in a single transaction
         try:
-            cur.execute('ALTER TABLE ' + osm_table + '\n' +
-                        'DROP COLUMN IF EXISTS district_id CASCADE\n')
-            cur.execute('ALTER TABLE ' + osm_table + '\n' +
-                        'ADD COLUMN district_id SMALLINT\n'
+            cur.execute('ALTER TABLE ' + table + '\n' +
+                        'DROP COLUMN IF EXISTS district_id CASCADE')
+            cur.execute('ALTER TABLE ' + table + '\n' +
+                        'RENAME COLUMN district_id_new TO district_id')
+            cur.execute('ALTER TABLE ' + table + '\n' +
+                        'ADD FOREIGN KEY (district_id)\n' +
                         'REFERENCES ' + districts_table + '(' + district_id_col + ')')
-        except psycopg2.ProgrammingError:
+        except psycopg2.Error as e:
             self.connection.rollback()
-            print "Could not drop or add district_id column to table " + osm_table + "."
+            print "Could not replace district_id column in table " + table + "."
             print ("Does the " + districts_table + " table exist and contain the " +
                    district_id_col + " column?")
+            print e
+            _drop_column(self.connection, table, 'district_id_new')
             return False
-        # N.B. not committed yet in case next stage fails
-
-        # get matching district ID for each establishment
-        sql = ('SELECT id, type, ' + district_id_col + ' as dist_id ' +
-               'FROM ' + osm_table + ' AS osm\n' +
-               'LEFT JOIN ' + districts_table + ' AS dist\n'
-               'ON ST_Contains(dist.geom, osm.geog::geometry)\n' +
-               'WHERE osm.geog IS NOT NULL')
-        cur.execute(sql)
-
-        # update each OSM entity with its district ID
-        for est in cur.fetchall():
-            osm_id, osm_type, dist_id = est
-            sql = ('UPDATE ' + osm_table + ' SET district_id = %s\n'
-                   'WHERE id = %s AND type = %s')
-            values = (dist_id, osm_id, osm_type)
-            try:
-                cur.execute(sql, values)
-            except psycopg2.ProgrammingError:
-                self.connection.rollback()
-                print "Couldn't update district_id column in " + osm_table + " table."
-                print "SQL statement and values for last attempted execute:"
-                print sql, values
-                return False
+        self.connection.commit()
+        self.create_district_index(table)
+        return True
 
-        # create index to speed up comparison with FHRS district_ids
-        cur.execute('CREATE INDEX ON ' + osm_table + ' (district_id);')
+    def create_district_index(self, table):
+        """Index the district_id column of a table, e.g. one whose district
+        IDs were added when it was written (see DistrictIndex)
 
+        table (string): name of table with district_id column
+        """
+        # index speeds up comparison with other tables' district_ids
+        cur = self.connection.cursor()
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_district_id_idx\n' +
+                    'ON ' + table + ' (district_id)')
+        cur.execute('ANALYZE ' + table)
         self.connection.commit()
-        return True
 
     def get_inhabited_districts(self, fhrs_table='fhrs_establishments',
                                 districts_table='districts', threshold=10):
@@ -176,22 +1377,69 @@ class Database(object):
             districts.append({'id': dist[0], 'name': dist[1]})
         return districts
 
+    def create_view(self, view_name, sql, values=None, materialised=False,
+                    unique_columns=None, index_columns=()):
+        """(Re)create a database view, dropping any dependent views first. A
+        materialised view is indexed so that it can be read quickly. If a
+        materialised view with the same definition already exists, it is
+        refreshed concurrently instead, so it can still be read meanwhile.
+
+        view_name (string): name for the view we're creating e.g. 'compare'
+        sql (string): SELECT statement defining the view
+        values (tuple): values to use in sql
+        materialised (boolean): create a materialised view?
+        unique_columns (list of strings): columns which together identify
+            each row of a materialised view (needed to refresh concurrently),
+            which must never be NULL as NULLs are never equal
+        index_columns (list of strings): other columns of a materialised
+            view to index
+        """
+
+        cur = self.connection.cursor()
+        definition = cur.mogrify(sql, values)
+        # the hash of the definition is stored as a comment on the view
+        definition_hash = hashlib.md5(definition).hexdigest()
+
+        if materialised:
+            cur.execute('SELECT relkind, obj_description(oid, \'pg_class\')\n' +
+                        'FROM pg_class WHERE oid = to_regclass(%s)', (view_name,))
+            row = cur.fetchone()
+            if row is not None and row[0] == 'm' and row[1] == definition_hash:
+                cur.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY ' + view_name)
+                self.connection.commit()
+                return
+
+        _drop_view(self.connection, view_name)
+
+        if not materialised:
+            cur.execute('CREATE VIEW ' + view_name + ' AS\n' + definition)
+            self.connection.commit()
+            return
+
+        cur.execute('CREATE MATERIALIZED VIEW ' + view_name + ' AS\n' + definition)
+        cur.execute('CREATE UNIQUE INDEX ' + view_name + '_key_idx\n' +
+                    'ON ' + view_name + ' (' + ', '.join(unique_columns) + ')')
+        for column in index_columns:
+            cur.execute('CREATE INDEX ' + view_name + '_' + column + '_idx\n' +
+                        'ON ' + view_name + ' (' + column + ')')
+        cur.execute('COMMENT ON MATERIALIZED VIEW ' + view_name + ' IS %s',
+                    (definition_hash,))
+        cur.execute('ANALYZE ' + view_name)
+        self.connection.commit()
+
     def create_comparison_view(self, view_name='compare', osm_table='osm',
-                               fhrs_table='fhrs_establishments'):
+                               fhrs_table='fhrs_establishments', materialised=False):
         """(Re)create database view to compare OSM and FHRS data. Drop any
         dependent views first.
 
         view_name (string): name for the view we're creating e.g. 'compare'
         osm_table (string): name of OSM database table
         fhrs_table (string): name of FHRS establishments database table
+        materialised (boolean): create an indexed materialised view? (see
+            create_view)
         """
 
-        cur = self.connection.cursor()
-        cur.execute('drop view if exists ' + view_name + ' cascade')
-        self.connection.commit()
-
-        sql = ('CREATE VIEW ' + view_name + ' AS\n' +
-               'SELECT o."name" as osm_name, f."BusinessName" as fhrs_name,\n' +
+        sql = ('SELECT o."name" as osm_name, f."BusinessName" as fhrs_name,\n' +
                'CASE\n' +
                '    WHEN o."id" IS NULL AND f."FHRSID" IS NOT NULL THEN \'FHRS\'\n' +
                '    WHEN o."id" IS NOT NULL AND f."FHRSID" IS NULL THEN\n' +
@@ -215,64 +1463,117 @@ class Database(object):
                'o."geog" AS osm_geog, f."geog" AS fhrs_geog,\n' +
                'o.id AS osm_id, o.type AS osm_type,\n' +
                'f."FHRSID" AS fhrs_fhrsid, o."fhrs:id" AS osm_fhrsid,\n' +
-               'o.district_id AS osm_district_id, f.district_id AS fhrs_district_id\n' +
+               'o.district_id AS osm_district_id, f.district_id AS fhrs_district_id,\n' +
+               # never NULL, unlike the keys of either table, so that it can
+               # identify each row of a materialised view (see create_view)
+               "concat_ws(':', o.type, o.id, o.idx, f.\"FHRSID\") AS row_key\n" +
                'FROM ' + fhrs_table + ' AS f\n' +
                'FULL OUTER JOIN ' + osm_table + ' AS o ON f."FHRSID"::text = o."fhrs:id"\n' +
                'WHERE COALESCE(o.geog, f.geog) IS NOT NULL')
-        cur.execute(sql)
-        self.connection.commit()
+        self.create_view(view_name, sql, materialised=materialised,
+                         unique_columns=['row_key'],
+                         index_columns=['osm_district_id', 'fhrs_district_id', 'status'])
 
     def create_suggest_matches_view(self, view_name='suggest_matches',
                                     osm_table='osm', fhrs_table='fhrs_establishments',
-                                    distance_metres=250, levenshtein_distance=3):
+                                    distance_metres=250, levenshtein_distance=3,
+                                    materialised=False, candidate_limit=10):
         """(Re)create database view to suggest possible matches between OSM and
         FHRS entities, examining names for exact substring match or Levenshtein
         distance-based fuzzy match as well as physical distance apart. Drop any
         dependent views first.
 
+        For each OSM entity, only a few unmatched FHRS establishments nearby
+        are examined, rather than every establishment in the same district:
+        those whose names are similar according to pg_trgm's % operator
+        (using the index created by create_name_index) or which contain or
+        are contained in the OSM name. Those with substring matches come
+        first, so they are never left out, followed by the rest in order of
+        trigram distance. N.B. names which are only within the Levenshtein
+        distance must also be similar by trigrams to be examined (see
+        pg_trgm.similarity_threshold).
+
         view_name (string): name for the view we're creating e.g. 'compare'
         osm_table (string): name of OSM database table
         fhrs_table (string): name of FHRS establishments database table
         distance_metres (numeric): max distance apart for points to be matched
         levenshtein_distance (integer): max Levenshtein distance for names to be matched
+        materialised (boolean): create an indexed materialised view? (see
+            create_view)
+        candidate_limit (integer): max number of FHRS establishments examined
+            for each OSM entity
         """
 
-        cur = self.connection.cursor()
-        cur.execute('drop view if exists ' + view_name + ' cascade')
-        self.connection.commit()
+        self.create_name_index(fhrs_table, '"BusinessName"')
 
-        sql = ('CREATE VIEW ' + view_name + ' AS\n' +
-               'SELECT o.name AS osm_name, f."BusinessName" AS fhrs_name,\n' +
-               'o.id AS osm_id, o.type AS osm_type, f."FHRSID",\n' +
+        # normalised names, matching the index created by create_name_index
+        fhrs_name = "replace(lower(c.\"BusinessName\"),'&','and')"
+        osm_name = "replace(lower(o.name),'&','and')"
+        # escape % with another %
+        substring_match = ('(' + fhrs_name + " LIKE '%%' || " + osm_name + " || '%%'\n" +
+                           '         OR ' + osm_name + " LIKE '%%' || " + fhrs_name + " || '%%')")
+
+        sql = ('SELECT o.name AS osm_name, f."BusinessName" AS fhrs_name,\n' +
+               'o.id AS osm_id, o.type AS osm_type, o.idx AS osm_idx, f."FHRSID",\n' +
                'f."AddressLine1", f."AddressLine2", \n' +
                'f."AddressLine3", f."AddressLine4", \n' +
                'f."PostCode", o."addr:postcode", \n' +
                'o.geog AS osm_geog, f.geog AS fhrs_geog,\n' +
                'o.district_id AS osm_district_id, f.district_id AS fhrs_district_id\n' +
                'FROM ' + osm_table + ' AS o\n' +
-               'INNER JOIN ' + fhrs_table + ' AS f\n' +
-               'ON o.district_id = f.district_id\n' +
+               # candidates are the nearby establishments in the same district
+               # with similar names, substring matches first and then in order
+               # of trigram distance
+               'CROSS JOIN LATERAL (\n' +
+               '    SELECT * FROM ' + fhrs_table + ' AS c\n' +
+               '    WHERE c.district_id = o.district_id\n' +
+               '    AND ST_DWithin(o.geog, c.geog, %s, false)\n' + # false = don't use spheroid
+               # check that FHRS ID not already used by another OSM entity
+               # (before the limit, so that used IDs don't take up candidate
+               # places); only check this district to speed up query
+               '    AND NOT EXISTS\n' +
+               '        (SELECT "fhrs:id" FROM ' + osm_table + '\n' +
+               '         WHERE district_id = o.district_id\n' +
+               '         AND "fhrs:id" = CAST(c."FHRSID" AS TEXT))\n' +
+               '    AND (' + fhrs_name + ' %% ' + osm_name + '\n' +
+               '         OR ' + substring_match + ')\n' +
+               '    ORDER BY ' + substring_match + ' DESC,\n' +
+               '    ' + fhrs_name + ' <-> ' + osm_name + '\n' +
+               '    LIMIT %s\n' +
+               ') AS f\n' +
+               'WHERE o."fhrs:id" IS NULL\n' +
+               'AND o.name IS NOT NULL\n' +
                # escape % with another %
                "AND (replace(lower(f.\"BusinessName\"),'&','and') LIKE '%%' || replace(lower(o.name),'&','and') || '%%'\n" +
                "     OR replace(lower(o.name),'&','and') LIKE '%%' || replace(lower(f.\"BusinessName\"),'&','and') || \'%%\'\n" +
-               "     OR levenshtein_less_equal(replace(lower(o.name),'&','and'), replace(lower(f.\"BusinessName\"),'&','and'), %s) < %s)\n" +
-               'AND ST_DWithin(o.geog, f.geog, %s, false)\n' + # false = don't use spheroid
-               'WHERE o."fhrs:id" IS NULL\n' +
-               # check that FHRS ID not already used by another OSM entity
-               # only check this district to speed up query
-               'AND NOT EXISTS\n' +
-               '    (SELECT "fhrs:id" FROM osm\n' +
-               '     WHERE district_id = o.district_id\n' +
-               '     AND "fhrs:id" = CAST(f."FHRSID" AS TEXT))\n' +
-               'ORDER BY o.name')
-        values = (levenshtein_distance, levenshtein_distance, distance_metres)
+               "     OR levenshtein_less_equal(replace(lower(o.name),'&','and'), replace(lower(f.\"BusinessName\"),'&','and'), %s) < %s)")
+        if not materialised:
+            # a materialised view's rows aren't kept in order anyway
+            sql += '\nORDER BY o.name'
+        values = (distance_metres, candidate_limit, levenshtein_distance, levenshtein_distance)
 
-        cur.execute(sql, values)
+        self.create_view(view_name, sql, values, materialised=materialised,
+                         unique_columns=['osm_id', 'osm_type', 'osm_idx', '"FHRSID"'],
+                         index_columns=['osm_district_id', 'fhrs_district_id'])
+
+    def create_name_index(self, table, column):
+        """Create a trigram index on the normalised (lower case, & replaced
+        with 'and') names in a table, which is used to find establishments
+        with similar names. Needs the pg_trgm extension (see setup.sh).
+
+        table (string): name of database table
+        column (string): name of name column (quoted if necessary)
+        """
+
+        cur = self.connection.cursor()
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_name_gin_idx\n' +
+                    'ON ' + table + ' USING GIN\n' +
+                    "((replace(lower(" + column + "),'&','and')) gin_trgm_ops)")
         self.connection.commit()
 
     def create_distant_matches_view(self, view_name='distant_matches',
                                     osm_table='osm', fhrs_table='fhrs_establishments',
-                                    distance_metres=500):
+                                    distance_metres=500, materialised=False):
         """(Re)create database view to compare the OSM and FHRS locations for
         matched establishments. Filters out matches using distance_metres to
         show only distant matches. Drop any dependent views first.
@@ -281,25 +1582,24 @@ class Database(object):
         osm_table (string): name of OSM database table
         fhrs_table (string): name of FHRS establishments database table
         distance_metres (numeric): minimum distance between OSM/FHRS locations
+        materialised (boolean): create an indexed materialised view? (see
+            create_view)
         """
 
-        cur = self.connection.cursor()
-        cur.execute('drop view if exists ' + view_name + ' cascade')
-        self.connection.commit()
-
-        sql = ('CREATE VIEW ' + view_name + ' AS\n' +
-               'SELECT o.id AS osm_id, TRIM(TRAILING \' \' FROM o.type) AS osm_type,\n' +
+        sql = ('SELECT o.id AS osm_id, TRIM(TRAILING \' \' FROM o.type) AS osm_type,\n' +
+               'o.idx AS osm_idx,\n' +
                'f."FHRSID" AS fhrs_id, o.name AS osm_name, f."BusinessName" AS fhrs_name,\n' +
                'o.district_id, ST_MakeLine(o.geog::geometry, f.geog::geometry) AS geom,\n' +
                'ST_Distance(o.geog, f.geog) AS distance\n' +
                'FROM ' + osm_table + ' o\n' +
-               'FULL OUTER JOIN ' + fhrs_table + ' f ON o."fhrs:id"::text = f."FHRSID"::text\n' +
+               'JOIN ' + fhrs_table + ' f ON o."fhrs:id"::text = f."FHRSID"::text\n' +
                'WHERE o.geog IS NOT NULL AND f.geog IS NOT NULL\n' +
                # first false = don't use spheroid for a faster calculation
-               'AND ST_DWithin(o.geog, f.geog, ' + str(distance_metres) + ', FALSE) IS FALSE;')
+               'AND ST_DWithin(o.geog, f.geog, ' + str(distance_metres) + ', FALSE) IS FALSE')
 
-        cur.execute(sql)
-        self.connection.commit()
+        self.create_view(view_name, sql, materialised=materialised,
+                         unique_columns=['osm_id', 'osm_type', 'osm_idx', 'fhrs_id'],
+                         index_columns=['district_id'])
 
     def get_overview_geojson(self, view_name='compare', fhrs_table='fhrs_establishments',
                              district_id=182, cluster_metres=3.5):
@@ -737,9 +2037,661 @@ class Database(object):
         return output
 
 
+class NodeLocationStore(object):
+    """A compact index of OSM node positions, used to locate ways and
+    relations without keeping every node as a Python object. Node IDs are
+    held in a sorted array of 64-bit integers, with latitudes and
+    longitudes in parallel arrays of 32-bit fixed-point integers (units of
+    1e-7 degrees, about 1cm), so each node takes 16 bytes. The arrays can be
+    saved to disk and memory-mapped when loaded, so that a store can be
+    reused across runs.
+
+    Nodes can be added in any order. They are buffered and merged into the
+    sorted arrays when they are next looked up.
+    """
+
+    scale = 10000000 # fixed-point units per degree
+    chunk_size = 1000000 # number of nodes buffered in lists
+
+    def __init__(self):
+        """Constructor"""
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.lats = numpy.zeros(0, dtype=numpy.int32)
+        self.lons = numpy.zeros(0, dtype=numpy.int32)
+        self.chunks = []
+        self.pending_ids = []
+        self.pending_lats = []
+        self.pending_lons = []
+        self.read_only = False
+
+    def __len__(self):
+        """Return number of nodes in the store"""
+        length = len(self.ids) + len(self.pending_ids)
+        for chunk in self.chunks:
+            length += len(chunk[0])
+        return length
+
+    def add(self, node_id, lon, lat):
+        """Add a node's position to the store
+
+        node_id (integer): OSM ID of node
+        lon/lat (decimals): position of node
+        """
+        self.pending_ids.append(node_id)
+        self.pending_lons.append(lon)
+        self.pending_lats.append(lat)
+        if len(self.pending_ids) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Convert the buffered nodes into a chunk of arrays"""
+        if len(self.pending_ids) == 0:
+            return
+        self.chunks.append((numpy.array(self.pending_ids, dtype=numpy.int64),
+                            self.to_fixed(self.pending_lats),
+                            self.to_fixed(self.pending_lons)))
+        self.pending_ids = []
+        self.pending_lats = []
+        self.pending_lons = []
+
+    def to_fixed(self, degrees):
+        """Convert positions in degrees to fixed-point integers
+
+        degrees (list of decimals): latitudes or longitudes
+        Returns numpy array
+        """
+        return numpy.round(numpy.array(degrees, dtype=numpy.float64) *
+                           self.scale).astype(numpy.int32)
+
+    def finalize(self):
+        """Merge any nodes added since the last lookup into the sorted arrays"""
+        self.flush()
+        if len(self.chunks) == 0:
+            return
+        ids = numpy.concatenate([self.ids] + [chunk[0] for chunk in self.chunks])
+        lats = numpy.concatenate([self.lats] + [chunk[1] for chunk in self.chunks])
+        lons = numpy.concatenate([self.lons] + [chunk[2] for chunk in self.chunks])
+        self.chunks = []
+        order = numpy.argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        self.lats = lats[order]
+        self.lons = lons[order]
+
+    def lookup_all(self, node_ids):
+        """Look up the positions of several nodes, e.g. those of a batch of
+        ways, including nodes which aren't in the store
+
+        node_ids (list of integers): OSM IDs of nodes
+        Returns tuple of numpy arrays (lons, lats, found), where found is
+            False for nodes which aren't in the store (whose lon and lat
+            are meaningless)
+        """
+        if len(self.pending_ids) > 0 or len(self.chunks) > 0:
+            self.finalize()
+        node_ids = numpy.asarray(node_ids, dtype=numpy.int64)
+        if len(self.ids) == 0:
+            zeros = numpy.zeros(len(node_ids), dtype=numpy.float64)
+            return zeros, zeros, numpy.zeros(len(node_ids), dtype=bool)
+        idx = numpy.searchsorted(self.ids, node_ids)
+        idx[idx == len(self.ids)] = 0
+        found = self.ids[idx] == node_ids
+        return (self.lons[idx] / float(self.scale),
+                self.lats[idx] / float(self.scale), found)
+
+    def lookup(self, node_ids):
+        """Look up the positions of several nodes. Nodes which aren't in the
+        store are left out.
+
+        node_ids (list of integers): OSM IDs of nodes
+        Returns tuple of numpy arrays of decimals (lons, lats)
+        """
+        lons, lats, found = self.lookup_all(node_ids)
+        return lons[found], lats[found]
+
+    def get_coords(self, node_ids):
+        """Look up the positions of several nodes, e.g. those of a way.
+        Nodes which aren't in the store are left out.
+
+        node_ids (list of integers): OSM IDs of nodes
+        Returns list of tuples (lon, lat)
+        """
+        lons, lats = self.lookup(node_ids)
+        return zip(lons.tolist(), lats.tolist())
+
+    def save(self, directory):
+        """Save the store to disk as numpy .npy files
+
+        directory (string): directory in which to save the arrays
+        """
+        self.finalize()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        numpy.save(os.path.join(directory, 'ids.npy'), self.ids)
+        numpy.save(os.path.join(directory, 'lats.npy'), self.lats)
+        numpy.save(os.path.join(directory, 'lons.npy'), self.lons)
+
+    def load(self, directory, mmap=True):
+        """Load a store previously saved to disk, replacing any nodes in
+        this one. The store is then marked as read only, so that it isn't
+        added to again when the same data is read.
+
+        directory (string): directory from which to load the arrays
+        mmap (boolean): memory-map the arrays rather than reading them?
+        """
+        if mmap:
+            mmap_mode = 'r'
+        else:
+            mmap_mode = None
+        self.ids = numpy.load(os.path.join(directory, 'ids.npy'), mmap_mode=mmap_mode)
+        self.lats = numpy.load(os.path.join(directory, 'lats.npy'), mmap_mode=mmap_mode)
+        self.lons = numpy.load(os.path.join(directory, 'lons.npy'), mmap_mode=mmap_mode)
+        self.chunks = []
+        self.pending_ids = []
+        self.pending_lats = []
+        self.pending_lons = []
+        self.read_only = True
+
+
+class CoverageGrid(object):
+    """The area covered by a set of points (e.g. FHRS establishments), as
+    the cells of a regular grid of latitude and longitude which contain at
+    least one point, plus a margin around them. Used so that only OSM data
+    near to the establishments is downloaded or written, rather than
+    everything within a single bounding box.
+
+    Cells are identified by their row and column, i.e. the latitude and
+    longitude of their south-west corner divided by the cell size.
+    """
+
+    key_base = 4294967296 # 2**32, used to combine rows and columns into keys
+
+    def __init__(self, cell_size=0.05, margin=0.01):
+        """Constructor
+
+        cell_size (decimal): width and height of cells in degrees
+        margin (decimal): distance in degrees around occupied cells which
+            is also treated as covered (at most half of cell_size)
+        """
+        if margin < 0 or margin * 2 > cell_size:
+            raise ValueError("margin must be between 0 and half of cell_size")
+        self.cell_size = cell_size
+        self.margin = margin
+        self.cells = set()
+        self.cell_keys = None # sorted numpy array of cell keys, built when needed
+
+    def __len__(self):
+        """Return number of occupied cells"""
+        return len(self.cells)
+
+    def add_cell(self, row, col):
+        """Mark a cell as occupied
+
+        row/col (integers): row and column of cell
+        """
+        self.cells.add((int(row), int(col)))
+        self.cell_keys = None
+
+    def add_point(self, lon, lat):
+        """Mark the cell containing a point as occupied
+
+        lon/lat (decimals): position of point
+        """
+        self.add_cell(math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def contains(self, lon, lat):
+        """Is a point within an occupied cell or its margin?
+
+        lon/lat (decimals): position of point
+        Returns boolean
+        """
+        # as the margin is no more than half a cell, a point is covered if
+        # any corner of the square of the margin around it is in a cell
+        for lon_offset in (-self.margin, self.margin):
+            for lat_offset in (-self.margin, self.margin):
+                if (int(math.floor((lat + lat_offset) / self.cell_size)),
+                        int(math.floor((lon + lon_offset) / self.cell_size))) in self.cells:
+                    return True
+        return False
+
+    def contains_all(self, lons, lats):
+        """Check whether several points are within occupied cells or their
+        margins at once
+
+        lons/lats (lists or numpy arrays of decimals): positions of points
+        Returns numpy array of booleans
+        """
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        covered = numpy.zeros(len(lons), dtype=bool)
+        if len(self.cells) == 0 or len(lons) == 0:
+            return covered
+        if self.cell_keys is None:
+            self.cell_keys = numpy.sort(numpy.array(
+                [row * self.key_base + col for row, col in self.cells], dtype=numpy.int64))
+        cell_keys = self.cell_keys
+        # as the margin is no more than half a cell, a point is covered if
+        # any corner of the square of the margin around it is in a cell
+        for lon_offset in set([-self.margin, self.margin]):
+            for lat_offset in set([-self.margin, self.margin]):
+                rows = numpy.floor((lats + lat_offset) / self.cell_size)
+                cols = numpy.floor((lons + lon_offset) / self.cell_size)
+                valid = numpy.isfinite(rows) & numpy.isfinite(cols)
+                keys = numpy.zeros(len(lons), dtype=numpy.int64)
+                keys[valid] = (rows[valid].astype(numpy.int64) * self.key_base +
+                               cols[valid].astype(numpy.int64))
+                found = numpy.searchsorted(cell_keys, keys)
+                found[found == len(cell_keys)] = 0
+                covered |= valid & (cell_keys[found] == keys)
+        return covered
+
+    def get_cell_bbox(self, rows, cols):
+        """Return the bounding box of a group of cells, including the margin
+
+        rows/cols (lists of integers): rows and columns of cells
+        Returns list of 4 decimals: bounding box co-ordinates [S,W,N,E]
+        """
+        return [round(min(rows) * self.cell_size - self.margin, 7),
+                round(min(cols) * self.cell_size - self.margin, 7),
+                round((max(rows) + 1) * self.cell_size + self.margin, 7),
+                round((max(cols) + 1) * self.cell_size + self.margin, 7)]
+
+    def get_bbox(self):
+        """Return the bounding box of all the occupied cells
+
+        Returns list of 4 decimals: bounding box co-ordinates [S,W,N,E]
+        """
+        rows, cols = zip(*self.cells)
+        return self.get_cell_bbox(rows, cols)
+
+    def get_rectangles(self, cells):
+        """Group cells into rectangles, by joining runs of occupied cells in
+        each row and then joining runs with the same columns in adjacent
+        rows
+
+        cells (list of tuples): (row, col) of each occupied cell
+        Returns list of tuples (first row, last row, first col, last col)
+        """
+        rows = {}
+        for row, col in cells:
+            rows.setdefault(row, []).append(col)
+        rectangles = []
+        open_rectangles = {} # rectangles reaching the previous row, by columns
+        for row in sorted(rows):
+            cols = sorted(rows[row])
+            runs = []
+            start = cols[0]
+            for prev, col in zip(cols[:-1], cols[1:]):
+                if col != prev + 1:
+                    runs.append((start, prev))
+                    start = col
+            runs.append((start, cols[-1]))
+
+            extended = {}
+            for run in runs:
+                rectangle = open_rectangles.pop(run, None)
+                if rectangle is not None and rectangle[1] == row - 1:
+                    rectangle[1] = row
+                else:
+                    if rectangle is not None:
+                        rectangles.append(rectangle)
+                    rectangle = [row, row, run[0], run[1]]
+                extended[run] = rectangle
+            rectangles.extend(open_rectangles.values())
+            open_rectangles = extended
+        rectangles.extend(open_rectangles.values())
+        return sorted(tuple(rectangle) for rectangle in rectangles)
+
+    def get_bboxes(self, tile_size=0.5):
+        """Split the occupied cells between a grid of tiles, and return the
+        bounding boxes of rectangles of occupied cells within each tile (see
+        get_rectangles), so that empty parts of tiles are left out. Used to
+        split a large area into Overpass API queries (see
+        OSMDataset.iter_overpass_tiles).
+
+        tile_size (decimal): width and height of tiles in degrees (0 for a
+            single bounding box around all the occupied cells)
+        Returns list of bounding boxes [S,W,N,E]
+        """
+        if len(self.cells) == 0:
+            return []
+        if not tile_size:
+            return [self.get_bbox()]
+        tiles = {}
+        for row, col in self.cells:
+            # use the centre of the cell so that rounding errors don't matter
+            tile = (int(math.floor((row + 0.5) * self.cell_size / tile_size)),
+                    int(math.floor((col + 0.5) * self.cell_size / tile_size)))
+            tiles.setdefault(tile, []).append((row, col))
+        bboxes = []
+        for tile in sorted(tiles):
+            for first_row, last_row, first_col, last_col in self.get_rectangles(tiles[tile]):
+                bboxes.append(self.get_cell_bbox([first_row, last_row],
+                                                 [first_col, last_col]))
+        return bboxes
+
+
+class DistrictIndex(object):
+    """An in-memory spatial index of district boundaries, used to tag FHRS
+    establishments and OSM entities with the ID of the district they are in
+    as they are written, rather than in a separate pass over the database
+    tables afterwards (see Database.update_districts). Districts are held
+    as prepared shapely geometries in an STRtree, and can be cached on disk
+    as WKB so that they're only read from the database when they change.
+
+    The districts found for each key given to lookup (e.g. an FHRS
+    LocalAuthorityCode) are remembered and tried first, as the
+    establishments of each authority are usually in one or two districts.
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self.district_ids = []
+        self.geoms = []
+        self.prepared = []
+        self.tree = None
+        self.tree_positions = {}
+        self.key_positions = {}
+
+    cache_header = 'FHRSDIST1' # identifies district cache files (see write_cache)
+
+    def __len__(self):
+        """Return number of districts in the index"""
+        return len(self.district_ids)
+
+    def get_signature(self, connection, districts_table='districts'):
+        """Return a value which changes when the districts table does, used to
+        check whether a cache file is out of date
+
+        connection (object): database connection
+        districts_table (string): name of table of district boundaries
+        Returns list of integers
+        """
+        cur = connection.cursor()
+        cur.execute('SELECT count(*), sum(ST_NPoints(geom)) FROM ' + districts_table)
+        return [int(value or 0) for value in cur.fetchone()]
+
+    def load(self, connection, districts_table='districts', district_id_col='gid',
+             cache_filename=None):
+        """Load the district boundaries from a cache file if it's up to date,
+        otherwise from the database (saving them to the cache file)
+
+        connection (object): database connection
+        districts_table (string): name of table of district boundaries
+        district_id_col (string): name of district ID column
+        cache_filename (string): file in which districts are cached as WKB
+            (not cached if None)
+        """
+        signature = self.get_signature(connection, districts_table)
+        districts = None
+        if cache_filename is not None and os.path.exists(cache_filename):
+            districts = self.read_cache(cache_filename, signature)
+
+        if districts is None:
+            cur = connection.cursor()
+            cur.execute('SELECT ' + district_id_col + ', ST_AsBinary(geom)\n' +
+                        'FROM ' + districts_table + '\n' +
+                        'WHERE geom IS NOT NULL\n' +
+                        'ORDER BY ' + district_id_col)
+            districts = [(int(district_id), str(geom_wkb))
+                         for district_id, geom_wkb in cur.fetchall()]
+            if cache_filename is not None:
+                self.write_cache(cache_filename, signature, districts)
+
+        self.set_districts(districts)
+
+    def read_cache(self, cache_filename, signature):
+        """Read district boundaries from a cache file written by write_cache
+
+        cache_filename (string): name of cache file
+        signature (list of integers): signature of the districts table (see
+            get_signature)
+        Returns list of tuples (district ID, boundary as WKB string), or
+            None if the file isn't a cache file or is out of date
+        """
+        f = open(cache_filename, 'rb')
+        try:
+            header = f.read(len(self.cache_header) + 24)
+            if (len(header) < len(self.cache_header) + 24 or
+                    not header.startswith(self.cache_header)):
+                return None
+            count, points, districts_count = struct.unpack(
+                '<qqq', header[len(self.cache_header):])
+            if [count, points] != signature:
+                return None
+            districts = []
+            for i in range(districts_count):
+                record = f.read(8)
+                if len(record) < 8:
+                    return None
+                district_id, length = struct.unpack('<ii', record)
+                geom_wkb = f.read(length)
+                if len(geom_wkb) < length:
+                    return None
+                districts.append((district_id, geom_wkb))
+            return districts
+        finally:
+            f.close()
+
+    def write_cache(self, cache_filename, signature, districts):
+        """Write district boundaries to a cache file: a header containing the
+        signature of the districts table and the number of districts,
+        followed by the ID, length and WKB of each district
+
+        cache_filename (string): name of cache file
+        signature (list of integers): signature of the districts table (see
+            get_signature)
+        districts (list of tuples): (district ID, boundary as WKB string)
+        """
+        # write to a temporary file then rename, so that a partially
+        # written cache is never read
+        directory = os.path.dirname(cache_filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_filename = cache_filename + '.' + str(os.getpid())
+        f = open(temp_filename, 'wb')
+        f.write(self.cache_header +
+                struct.pack('<qqq', signature[0], signature[1], len(districts)))
+        for district_id, geom_wkb in districts:
+            f.write(struct.pack('<ii', district_id, len(geom_wkb)))
+            f.write(geom_wkb)
+        f.close()
+        os.rename(temp_filename, cache_filename)
+
+    def set_districts(self, districts):
+        """Build the index from a list of district boundaries, replacing any
+        districts already in it
+
+        districts (list of tuples): (district ID, boundary as WKB string)
+        """
+        self.district_ids = [district_id for district_id, geom_wkb in districts]
+        self.geoms = [wkb.loads(geom_wkb) for district_id, geom_wkb in districts]
+        self.prepared = [prep(geom) for geom in self.geoms]
+        # STRtree.query returns geometries, so map them back to positions
+        self.tree_positions = dict((id(geom), i) for i, geom in enumerate(self.geoms))
+        self.key_positions = {}
+        if len(self.geoms) > 0:
+            self.tree = STRtree(self.geoms)
+        else:
+            self.tree = None
+
+    def lookup(self, lon, lat, key=None):
+        """Return the ID of the district containing a point
+
+        lon/lat (decimals or strings): position of point
+        key (hashable): if supplied, the districts previously found for this
+            key are tried first
+        Returns integer, or None if the point isn't in any district
+        """
+        try:
+            lon = float(lon)
+            lat = float(lat)
+        except (TypeError, ValueError):
+            return None
+        if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+            return None
+        point = Point(lon, lat)
+
+        if key is not None:
+            for i in self.key_positions.get(key, ()):
+                if self.prepared[i].intersects(point):
+                    return self.district_ids[i]
+
+        if self.tree is None:
+            return None
+        for geom in self.tree.query(point):
+            i = self.tree_positions[id(geom)]
+            if self.prepared[i].intersects(point):
+                if key is not None:
+                    positions = self.key_positions.setdefault(key, [])
+                    if i not in positions:
+                        positions.append(i)
+                return self.district_ids[i]
+        return None
+
+
+class OSMElement(object):
+    """A lightweight record representing an OSM node, way or relation, used
+    instead of overpy objects when streaming OSM XML so that large files
+    can be parsed without holding all of their elements in memory.
+
+    type (string): 'node', 'way' or 'relation'
+    id (integer): OSM ID
+    tags (dict): tag/value pairs
+    lat/lon (decimals): position of node, or centre of way or relation if
+        returned by Overpass API (otherwise None)
+    nodes (list of integers): IDs of way's nodes
+    members (list of tuples): (type, ref) for each of relation's members
+    coords (list of tuples): (lon, lat) of each of way's nodes, if known
+        when the way is read (None otherwise)
+    """
+
+    __slots__ = ('type', 'id', 'tags', 'lat', 'lon', 'nodes', 'members', 'coords')
+
+    def __init__(self, osm_type, osm_id, tags=None, lat=None, lon=None,
+                 nodes=None, members=None, coords=None):
+        """Constructor
+
+        osm_type (string): 'node', 'way' or 'relation'
+        osm_id (integer): OSM ID
+        tags (dict): tag/value pairs
+        lat/lon (decimals): position of node
+        nodes (list of integers): IDs of way's nodes
+        members (list of tuples): (type, ref) for each of relation's members
+        coords (list of tuples): (lon, lat) of each of way's nodes
+        """
+        self.type = osm_type
+        self.id = osm_id
+        self.tags = tags or {}
+        self.lat = lat
+        self.lon = lon
+        self.nodes = nodes or []
+        self.members = members or []
+        self.coords = coords
+
+
+class TagFilter(object):
+    """A class which decides whether OSM entities are relevant based on their
+    tags, built once from the tag/value and tag exists lists so that each
+    tag can be checked with a dict lookup. It is also used to generate the
+    Overpass query and the osmosis filter, so that all of these use the
+    same criteria.
+
+    tag_value_list (list of dicts): tag/value pairs e.g.
+        [{'t': 'amenity', 'v': 'bar'}]
+    tag_exists_list (list of strings): tags which match whatever their value
+    """
+
+    def __init__(self, tag_value_list, tag_exists_list):
+        """Constructor
+
+        tag_value_list (list of dicts): tag/value pairs
+        tag_exists_list (list of strings): tags which match whatever their value
+        """
+        # keep the tags in their original order for generating queries
+        self.values = OrderedDict()
+        for this in tag_value_list:
+            self.values.setdefault(this['t'], [])
+            if this['v'] not in self.values[this['t']]:
+                self.values[this['t']].append(this['v'])
+        self.value_sets = {}
+        for tag, values in self.values.iteritems():
+            self.value_sets[tag] = frozenset(values)
+        self.exists = list(tag_exists_list)
+        self.exists_set = frozenset(tag_exists_list)
+
+    def matches(self, tags):
+        """Check whether any of an entity's tags match our criteria
+
+        tags (dict): tag/value pairs
+        Returns boolean
+        """
+        for tag, value in tags.iteritems():
+            if tag in self.exists_set:
+                return True
+            values = self.value_sets.get(tag)
+            if values is not None and value in values:
+                return True
+        return False
+
+    def get_overpass_clauses(self, group=True):
+        """Return the Overpass QL statements which select matching entities
+
+        group (boolean): select all the values for each tag using a single
+            regular expression, so that the server only has to look for
+            each tag once, rather than one statement per tag/value pair?
+        Returns list of strings
+        """
+        clauses = []
+        for tag, values in self.values.iteritems():
+            if group and len(values) > 1:
+                regex = '^(' + '|'.join([self.escape_regex(v) for v in values]) + ')$'
+                clauses.append('nwr["' + self.escape_ql(tag) + '"~"' +
+                               self.escape_ql(regex) + '"];')
+            else:
+                for value in values:
+                    clauses.append('nwr["' + self.escape_ql(tag) + '"="' +
+                                   self.escape_ql(value) + '"];')
+        for tag in self.exists:
+            clauses.append('nwr["' + self.escape_ql(tag) + '"];')
+        return clauses
+
+    def escape_regex(self, value):
+        """Escape characters with a special meaning in a regular expression
+
+        value (string): tag value
+        Returns string
+        """
+        return re.sub(r'([\\.^$|?*+()\[\]{}])', r'\\\1', value)
+
+    def escape_ql(self, value):
+        """Escape characters with a special meaning in an Overpass QL string
+
+        value (string): string to be quoted
+        Returns string
+        """
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
+    def get_osmosis_filter(self):
+        """Return the tag filter used by osmosis (e.g. in filter-osm.sh) to
+        select matching entities
+
+        Returns string e.g. 'amenity=bar,cafe shop=bakery fhrs:id=*'
+        """
+        filters = []
+        for tag, values in self.values.iteritems():
+            filters.append(tag + '=' + ','.join(values))
+        for tag in self.exists:
+            filters.append(tag + '=*')
+        return ' '.join(filters)
+
+
 class OSMDataset(object):
     """A class which represents the OSM data we are using."""
 
+    overpass_url = 'http://overpass-api.de/api/interpreter'
+    centroid_batch_size = 10000 # max number of ways/relations located at once
+    district_index = None # DistrictIndex used to tag entities with their district
+
     def __init__(self, tag_value_list=[{'t': 'amenity', 'v': 'bar'},
                                        {'t': 'amenity', 'v': 'cafe'},
                                        {'t': 'amenity', 'v': 'care_home'},
@@ -804,43 +2756,66 @@ class OSMDataset(object):
                  table_name='osm'):
         """Constructor
 
-        tag_value_list (list of dicts): tag/value pairs to use in Overpass query
-        tag_exists_list (list of strings): tags to use in Overpass query
+        tag_value_list (list of dicts): tag/value pairs to use in Overpass query,
+            osmosis filter and when filtering entities (see TagFilter)
+        tag_exists_list (list of strings): tags to use in the same way
         field_list (list of dicts): field/format dicts representing DB fields
         table_name (string): database table name to use for storing OSM entities
         """
         self.tag_value_list = tag_value_list
         self.tag_exists_list = tag_exists_list
+        self.tag_filter = TagFilter(tag_value_list, tag_exists_list)
         self.field_list = field_list
         self.table_name = table_name
 
-    def create_table(self, connection):
+        # position of each field in the rows returned by get_entity_rows
+        self.field_positions = {}
+        for i, this_field in enumerate(field_list):
+            self.field_positions[this_field['name']] = 5 + i
+
+    def create_table(self, connection, if_not_exists=False):
         """(Re)create the OSM database table, first dropping any existing table
         with the same name and any views dependent on it.
 
         connection (object): database connection object
+        if_not_exists (boolean): keep the existing table (and its data,
+            indexes and dependent views) if there is one, adding any
+            columns it is missing?
         """
 
         cur = connection.cursor()
-        cur.execute('DROP VIEW IF EXISTS compare CASCADE')
-        connection.commit()
-        cur.execute('DROP TABLE IF EXISTS ' + self.table_name + ' CASCADE')
-        connection.commit()
+        if not if_not_exists:
+            _drop_view(connection, 'compare')
+            cur.execute('DROP TABLE IF EXISTS ' + self.table_name + ' CASCADE')
+            connection.commit()
 
-        sql = 'CREATE TABLE ' + self.table_name + '\n'
+        sql = 'CREATE TABLE IF NOT EXISTS ' + self.table_name + '\n'
         # N.B. field names case sensitive because surrounded by ""
         sql += '(id BIGINT, geog GEOGRAPHY(POINT, 4326), type CHAR(8), idx SMALLINT,\n'
         for this_field in self.field_list:
             sql += '"' + this_field['name'] + '" ' + this_field['format'] + ','
-        sql += '\nPRIMARY KEY (id, type, idx))'
+        sql += '\ndistrict_id SMALLINT, content_hash CHAR(32), PRIMARY KEY (id, type, idx))'
         cur.execute(sql)
+
+        # add any columns missing from a table created by an older version
+        columns = [('"' + this_field['name'] + '"', this_field['format'])
+                   for this_field in self.field_list]
+        columns.extend([('district_id', 'SMALLINT'), ('content_hash', 'CHAR(32)')])
+        for column, column_format in columns:
+            cur.execute('ALTER TABLE ' + self.table_name + '\n' +
+                        'ADD COLUMN IF NOT EXISTS ' + column + ' ' + column_format)
         connection.commit()
 
-    def run_overpass_query(self, bbox=[52.314,-1.356,52.412,-1.178], timeout=180):
-        """Run Overpass API query based on bounding box and tag list supplied.
+    def get_overpass_query(self, bbox=[52.314,-1.356,52.412,-1.178], timeout=180,
+                           center=False):
+        """Return Overpass API query based on bounding box and tag list supplied.
 
         bbox (list of 4 decimals): bounding box co-ordinates [S,W,N,E]
-        Returns overpy.Result object
+        timeout (integer): server-side timeout in seconds
+        center (boolean): have the server return the centre of each way and
+            relation (the centre of its bounding box) instead of the nodes
+            needed to calculate it?
+        Returns string
         """
         # header elements
         query = '[out:xml][timeout:' + str(timeout) + ']'
@@ -848,172 +2823,780 @@ class OSMDataset(object):
         query += ','.join(map(str, bbox)) # comma separated list of bbox co-ordinates
         query += '];\n'
 
-        # tag/value list
-        query += '(\n'
-        for this in self.tag_value_list:
-            query += '\tnwr["' + this['t'] + '"="' + this['v'] + '"];\n'
+        # tag/value and tag exists lists
+        query += '(\n'
+        for clause in self.tag_filter.get_overpass_clauses():
+            query += '\t' + clause + '\n'
+        query += ');\n'
+
+        # closing elements
+        if center:
+            query += 'out center;'
+        else:
+            query += ('(._;>;);\n' + # include nodes used in ways
+                      'out;')
+        return query
+
+    def run_overpass_query(self, bbox=[52.314,-1.356,52.412,-1.178], timeout=180):
+        """Run Overpass API query based on bounding box and tag list supplied.
+
+        bbox (list of 4 decimals): bounding box co-ordinates [S,W,N,E]
+        Returns overpy.Result object
+        """
+        api = overpy.Overpass(url=self.overpass_url)
+        return api.query(self.get_overpass_query(bbox, timeout))
+
+    def open_overpass_query(self, bbox=[52.314,-1.356,52.412,-1.178], timeout=180,
+                            center=False):
+        """Run Overpass API query based on bounding box and tag list supplied,
+        without reading the result, so that it can be streamed using
+        iter_xml_elements.
+
+        bbox (list of 4 decimals): bounding box co-ordinates [S,W,N,E]
+        timeout (integer): server-side timeout in seconds
+        center (boolean): return the centre of each way and relation instead
+            of its nodes? (see get_overpass_query)
+        Returns file-like HTTP response containing OSM XML
+        """
+        request = urllib2.Request(self.overpass_url,
+                                  data=self.get_overpass_query(bbox, timeout, center))
+        # allow a little longer than the server-side timeout
+        return urllib2.urlopen(request, timeout=timeout + 60)
+
+    def get_tiles(self, bbox, tile_size=0.5):
+        """Split a bounding box into a grid of tiles, so that a large area can
+        be queried using several smaller Overpass API queries
+
+        bbox (list of 4 decimals): bounding box co-ordinates [S,W,N,E]
+        tile_size (decimal): width and height of tiles in degrees (0 for a
+            single tile covering the whole bounding box)
+        Returns list of bounding boxes [S,W,N,E]
+        """
+        if not tile_size:
+            return [list(bbox)]
+        south, west, north, east = bbox
+        rows = max(1, int(math.ceil((north - south) / tile_size)))
+        cols = max(1, int(math.ceil((east - west) / tile_size)))
+        tiles = []
+        for row in range(rows):
+            for col in range(cols):
+                tiles.append([round(south + row * tile_size, 7),
+                              round(west + col * tile_size, 7),
+                              round(min(north, south + (row + 1) * tile_size), 7),
+                              round(min(east, west + (col + 1) * tile_size), 7)])
+        return tiles
+
+    def split_tile(self, tile):
+        """Split a tile into four quarters
+
+        tile (list of 4 decimals): bounding box co-ordinates [S,W,N,E]
+        Returns list of bounding boxes [S,W,N,E]
+        """
+        south, west, north, east = tile
+        mid_lat = round((south + north) / 2.0, 7)
+        mid_lon = round((west + east) / 2.0, 7)
+        return [[south, west, mid_lat, mid_lon], [south, mid_lon, mid_lat, east],
+                [mid_lat, west, north, mid_lon], [mid_lat, mid_lon, north, east]]
+
+    def fetch_overpass_tile(self, tile, timeout=180, center=False, max_attempts=3,
+                            first_sleep_time=10, min_tile_size=0.05):
+        """Run Overpass API query for a single tile and read the result. If
+        the query fails, it is retried, waiting a random time which doubles
+        with each attempt. If it still fails, perhaps because the tile
+        contains too much data, the tile is split into quarters which are
+        queried in turn. HTTP client errors (other than 429 Too Many
+        Requests) are raised straight away, as retrying won't help.
+
+        tile (list of 4 decimals): bounding box co-ordinates [S,W,N,E]
+        timeout (integer): server-side timeout in seconds
+        center (boolean): return the centre of each way and relation instead
+            of its nodes? (see get_overpass_query)
+        max_attempts (integer): max number of times to query each tile
+        first_sleep_time (integer): max number of seconds to wait before
+            the first retry
+        min_tile_size (decimal): size in degrees below which a tile which
+            fails isn't split any further
+        Returns list of OSMElement objects
+        """
+        for attempt in range(1, max_attempts + 1):
+            try:
+                response = self.open_overpass_query(bbox=tile, timeout=timeout,
+                                                    center=center)
+                try:
+                    return list(self.iter_xml_elements(response))
+                finally:
+                    response.close()
+            except (urllib2.URLError, socket.error, httplib.HTTPException,
+                    xml.etree.cElementTree.ParseError, RuntimeError) as e:
+                if (isinstance(e, urllib2.HTTPError) and e.code < 500
+                        and e.code != 429):
+                    raise
+                error = sys.exc_info()
+                print ("Overpass query for tile " + str(tile) +
+                       " failed (attempt " + str(attempt) + "): " + str(e))
+                if attempt < max_attempts:
+                    sleep(random.uniform(0, first_sleep_time * 2 ** (attempt - 1)))
+
+        if tile[2] - tile[0] < min_tile_size * 2 or tile[3] - tile[1] < min_tile_size * 2:
+            exc_type, exc_value, exc_tb = error
+            raise exc_type, exc_value, exc_tb
+        print "Splitting tile " + str(tile) + " into quarters"
+        elements = []
+        for quarter in self.split_tile(tile):
+            elements.extend(self.fetch_overpass_tile(quarter, timeout, center, max_attempts,
+                                                     first_sleep_time, min_tile_size))
+        return elements
+
+    def iter_overpass_tiles(self, bbox=None, tile_size=0.5, max_workers=2, timeout=180,
+                            center=False, tiles=None):
+        """Query Overpass API for a large area by splitting it into tiles,
+        several of which are queried at once, yielding the elements from
+        each tile in turn. Elements which appear in more than one tile
+        (e.g. ways crossing the edge of a tile) are only yielded once. A
+        single tile is streamed straight from the response instead, so it
+        isn't retried or split if it fails.
+
+        Each tile's nodes come before its ways, and relations are held back
+        until every tile has been read, so that each node is yielded before
+        the ways which use it and every way before the relations (as
+        write_elements needs).
+
+        bbox (list of 4 decimals): bounding box co-ordinates [S,W,N,E]
+        tile_size (decimal): width and height of tiles in degrees (see get_tiles)
+        max_workers (integer): max number of queries to run at once
+        timeout (integer): server-side timeout in seconds
+        center (boolean): return the centre of each way and relation instead
+            of its nodes? (see get_overpass_query)
+        tiles (list of bounding boxes): tiles to query instead of splitting
+            bbox, e.g. from CoverageGrid.get_bboxes
+        Yields OSMElement object for each node, way and relation
+        """
+
+        if tiles is None:
+            tiles = self.get_tiles(bbox, tile_size)
+
+        if len(tiles) == 1:
+            response = self.open_overpass_query(bbox=tiles[0], timeout=timeout,
+                                                center=center)
+            try:
+                for element in self.iter_xml_elements(response):
+                    yield element
+            finally:
+                response.close()
+            return
+
+        def fetch_tile(tile):
+            return self.fetch_overpass_tile(tile, timeout=timeout, center=center)
+
+        seen = {'node': set(), 'way': set(), 'relation': set()}
+        relations = []
+        for i, elements in enumerate(_thread_imap(fetch_tile, tiles, max_workers)):
+            print ("Fetched Overpass tile " + str(i + 1) + " of " + str(len(tiles)) +
+                   " (" + str(len(elements)) + " elements)")
+            for element in elements:
+                ids = seen[element.type]
+                if element.id in ids:
+                    continue
+                ids.add(element.id)
+                if element.type == 'relation':
+                    # member ways may be in later tiles
+                    relations.append(element)
+                else:
+                    yield element
+        for element in relations:
+            yield element
+
+    def parse_xml_file(self, filename):
+        """Parse XML file. N.B. the whole file is held in memory, so use
+        iter_xml_elements for large files.
+
+        Returns overpy.Result object
+        """
+        api = overpy.Overpass()
+        f = open(filename)
+        xml = f.read()
+        f.close()
+
+        return api.parse_xml(xml)
+
+    def iter_xml_elements(self, source):
+        """Parse OSM XML incrementally, yielding each node, way and relation
+        as soon as it has been read. Each element is discarded once it has
+        been read, so memory use doesn't depend on the size of the XML.
+
+        source (file-like object): OSM XML e.g. a planet extract file or an
+            Overpass API response (see open_overpass_query), in which case
+            ways and relations may have a centre rather than nodes
+        Yields OSMElement object for each node, way and relation
+        """
+
+        element_tags = ('node', 'way', 'relation')
+        parents = []
+        for event, elem in xml.etree.cElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+
+            if elem.tag in element_tags:
+                tags = {}
+                nodes = []
+                members = []
+                center = None
+                for child in elem:
+                    if child.tag == 'tag':
+                        tags[child.get('k')] = child.get('v')
+                    elif child.tag == 'nd':
+                        nodes.append(int(child.get('ref')))
+                    elif child.tag == 'member':
+                        members.append((child.get('type'), int(child.get('ref'))))
+                    elif child.tag == 'center':
+                        # position of way or relation calculated by Overpass API
+                        center = child
+                if elem.tag == 'node':
+                    lat = elem.get('lat')
+                    lon = elem.get('lon')
+                elif center is not None:
+                    lat = center.get('lat')
+                    lon = center.get('lon')
+                else:
+                    lat = lon = None
+                if lat is not None and lon is not None:
+                    lat = float(lat)
+                    lon = float(lon)
+                element = OSMElement(elem.tag, int(elem.get('id')), tags=tags,
+                                     lat=lat, lon=lon, nodes=nodes, members=members)
+                # discard this element now that we've read it
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+                yield element
+            elif elem.tag == 'remark':
+                # Overpass API reports errors such as timeouts this way
+                raise RuntimeError("Overpass API returned an error: " + (elem.text or ''))
+
+    def get_pbf_relation_members(self, filename):
+        """Read the relations in a PBF file and return the IDs of the members
+        of those which match our criteria. Relations come after the nodes
+        and ways in a PBF file, so this is needed before the nodes and ways
+        can be filtered.
+
+        filename (string): path of PBF file
+        Returns tuple of sets of integers (node IDs, way IDs)
+        """
+
+        if osmium is None:
+            raise RuntimeError("The osmium module is needed to read PBF files")
+        dataset = self
+        node_ids = set()
+        way_ids = set()
+
+        class RelationHandler(osmium.SimpleHandler):
+            def relation(self, relation):
+                tags = dict((tag.k, tag.v) for tag in relation.tags)
+                if dataset.tags_match(tags):
+                    for member in relation.members:
+                        if member.type == 'n':
+                            node_ids.add(member.ref)
+                        elif member.type == 'w':
+                            way_ids.add(member.ref)
+
+        RelationHandler().apply_file(filename)
+        return node_ids, way_ids
+
+    def iter_pbf_elements(self, filename, index='flex_mem', queue_size=10000):
+        """Read a PBF file (e.g. a planet extract) directly, without filtering
+        it with osmosis first, yielding the nodes, ways and relations which
+        match our criteria as OSMElement objects, together with the nodes
+        and ways which are members of matching relations. Ways are yielded
+        with their nodes' positions, which osmium keeps in an index while
+        reading the file. The file is read in a separate thread, with
+        osmium decompressing blocks of the file using several threads.
+
+        N.B. the file is read twice, as relations come after the nodes and
+        ways in a PBF file: first for the members of matching relations
+        (see get_pbf_relation_members), then for everything else. Reading
+        it once would mean keeping the bounding box of every way in memory
+        until the relations had been read.
+
+        filename (string): path of PBF file
+        index (string): type of osmium node location index e.g. 'flex_mem'
+            or 'dense_file_array,FILENAME' for a large file
+        queue_size (integer): max number of elements read but not yet yielded
+        Yields OSMElement object for each node, way and relation
+        """
 
-        # tag exists list
-        for this in self.tag_exists_list:
-            query += '\tnwr["' + this + '"];\n'
+        print "Reading relations from " + filename
+        relation_node_ids, relation_way_ids = self.get_pbf_relation_members(filename)
+        dataset = self
+        elements = Queue.Queue(maxsize=queue_size)
+        member_types = {'n': 'node', 'w': 'way', 'r': 'relation'}
+        stopped = threading.Event() # set if the consumer stops early
 
-        query += ');\n'
+        class ReaderStopped(Exception):
+            pass
 
-        # closing elements
-        query += ('(._;>;);\n' + # include nodes used in ways
-                  'out;')
+        def put(item):
+            # give up if the consumer has stopped, rather than blocking for good
+            while not stopped.is_set():
+                try:
+                    elements.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+            raise ReaderStopped()
+
+        class ElementHandler(osmium.SimpleHandler):
+            def node(self, node):
+                if len(node.tags) == 0 and node.id not in relation_node_ids:
+                    return
+                tags = dict((tag.k, tag.v) for tag in node.tags)
+                if node.id in relation_node_ids or dataset.tags_match(tags):
+                    put(OSMElement('node', node.id, tags=tags,
+                                   lat=node.location.lat,
+                                   lon=node.location.lon))
+
+            def way(self, way):
+                if len(way.tags) == 0 and way.id not in relation_way_ids:
+                    return
+                tags = dict((tag.k, tag.v) for tag in way.tags)
+                if way.id in relation_way_ids or dataset.tags_match(tags):
+                    nodes = []
+                    coords = []
+                    for node in way.nodes:
+                        if node.location.valid():
+                            nodes.append(node.ref)
+                            coords.append((node.location.lon, node.location.lat))
+                    put(OSMElement('way', way.id, tags=tags,
+                                   nodes=nodes, coords=coords))
+
+            def relation(self, relation):
+                tags = dict((tag.k, tag.v) for tag in relation.tags)
+                if dataset.tags_match(tags):
+                    members = []
+                    for member in relation.members:
+                        members.append((member_types[member.type], member.ref))
+                    put(OSMElement('relation', relation.id, tags=tags,
+                                   members=members))
+
+        def reader():
+            try:
+                ElementHandler().apply_file(filename, locations=True, idx=index)
+                put(None) # tell the consumer we've finished
+            except ReaderStopped:
+                return
+            except Exception:
+                try:
+                    put(sys.exc_info())
+                except ReaderStopped:
+                    pass
+
+        print "Reading nodes, ways and relations from " + filename
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = elements.get()
+                if item is None:
+                    return
+                if isinstance(item, tuple):
+                    exc_type, exc_value, exc_tb = item
+                    raise exc_type, exc_value, exc_tb
+                yield item
+        finally:
+            stopped.set()
+
+    def tags_match(self, tags):
+        """Check whether any of an entity's tags match our criteria
+
+        tags (dict): tag/value pairs
+        Returns boolean
+        """
+        return self.tag_filter.matches(tags)
 
-        # run the query
-        api = overpy.Overpass()
-        return api.query(query)
+    def in_coverage(self, tags, lon, lat, coverage):
+        """Check whether an entity should be written given the area covered.
+        Entities with an fhrs:id tag are always written, so that links to
+        establishments outside the coverage aren't lost.
 
-    def parse_xml_file(self, filename):
-        """Parse XML file
+        tags (dict): tag/value pairs
+        lon/lat (decimals): position of entity
+        coverage (object): CoverageGrid, or None to write everything
+        Returns boolean
+        """
+        return (coverage is None or 'fhrs:id' in tags or
+                coverage.contains(lon, lat))
 
-        Returns overpy.Result object
+    def get_columns(self):
+        """Return the names of the values in each row returned by
+        get_entity_rows
+
+        Returns list of strings
         """
-        api = overpy.Overpass()
-        f = open(filename)
-        xml = f.read()
-        f.close()
+        columns = ['id', 'lon', 'lat', 'type', 'idx']
+        for this_field in self.field_list:
+            columns.append(this_field['name'])
+        if self.district_index is not None:
+            columns.append('district_id')
+        return columns
 
-        return api.parse_xml(xml)
+    def get_loader(self, connection, upsert=False, reject_filename=None):
+        """Return a BulkLoader for writing rows of OSM entities
+
+        connection (object): database connection
+        upsert (boolean): update existing rows with the same id, type and
+            idx if their content has changed?
+        reject_filename (string): file to which entities which can't be
+            inserted are appended (printed if None)
+        Returns BulkLoader object
+        """
+        if upsert:
+            upsert_key = ['id', 'type', 'idx']
+        else:
+            upsert_key = None
+        return BulkLoader(connection, self.table_name, self.get_columns(),
+                          reject_filename=reject_filename,
+                          upsert_key=upsert_key, hash_column='content_hash')
 
-    def write_entity(self, entity, lat, lon, connection):
-        """Write a single OSM node or way to the database
+    def write_entity(self, entity, lat, lon, connection, loader=None):
+        """Write a single OSM node or way to the database. If a loader is
+        given, the entity is added to its buffer and written using COPY
+        with the rest of the batch, so the loader must be flushed once all
+        the entities have been added (see finish_writing).
 
         entity (object): object representing the node or way
         lat/lon (decimals): latitude and longitude of point
         connection (object): database connection
+        loader (object): BulkLoader used to write the entity (see get_loader)
         """
 
-        # create list of fields still to match for this OSM entity
-        fields_to_check = []
-        for this_field in self.field_list:
-            fields_to_check.append(this_field['name'])
-
-        # create a blank dict to store relevant data for this OSM node/way/relation
-        # need to keep it in order so we can write it to the database
-        record = OrderedDict()
-
-        record['id'] = entity.id
-        record['geog'] = ("ST_GeogFromText('SRID=4326;POINT(" +
-                          str(lon) + " " + str(lat) + ")')")
-        record['type'] = None
-        if (type(entity) == overpy.Node):
-            record['type'] = 'node'
-        elif (type(entity) == overpy.Way):
-            record['type'] = 'way'
-        elif (type(entity) == overpy.Relation):
-            record['type'] = 'relation'
-        record['idx'] = 0
+        if loader is None:
+            loader = self.get_loader(connection)
+            loader.load_rows_singly(self.get_entity_rows(entity, lat, lon))
+            connection.commit()
+        else:
+            loader.add(self.get_entity_rows(entity, lat, lon))
+
+    def get_entity_rows(self, entity, lat, lon):
+        """Return rows of values to be written to the database for a single
+        OSM node, way or relation, one for each of its FHRS IDs
+
+        entity (object): object representing the node, way or relation
+        lat/lon (decimals): latitude and longitude of point
+        Returns list of tuples in the same order as get_columns
+        """
 
         # start with this record's tags set to None
-        for this_field in fields_to_check:
-            record[this_field] = None
+        row = [entity.id, lon, lat, None, 0] + [None] * len(self.field_list)
+        if isinstance(entity, OSMElement):
+            row[3] = entity.type
+        elif (type(entity) == overpy.Node):
+            row[3] = 'node'
+        elif (type(entity) == overpy.Way):
+            row[3] = 'way'
+        elif (type(entity) == overpy.Relation):
+            row[3] = 'relation'
 
-        # iterate through this entity's OSM tags
+        # iterate through this entity's OSM tags, storing the values of those
+        # which are in our list of fields
         for entity_key, entity_value in entity.tags.iteritems():
-            # if the OSM tag is in list of fields to check, store its value in dict
-            if entity_key in fields_to_check:
-                record[entity_key] = entity_value
-                # if we found a matching tag, we don't need to check for it again
-                fields_to_check.remove(entity_key)
+            if entity_key in self.field_positions:
+                row[self.field_positions[entity_key]] = entity_value
+
+        if self.district_index is not None:
+            row.append(self.district_index.lookup(lon, lat))
 
         # Set up array of FHRS IDs
-        if record['fhrs:id'] is None:
+        fhrsid_pos = self.field_positions['fhrs:id']
+        if row[fhrsid_pos] is None:
             fhrsids = [ None ]
         else:
-            fhrsids = sorted(set(record['fhrs:id'].split(";")))
+            fhrsids = sorted(set(row[fhrsid_pos].split(";")))
 
-        # Loop over each fhrsid
+        # one row for each fhrsid
+        rows = []
         for i in range(len(fhrsids)):
-            record['idx'] = i
-            record['fhrs:id'] = fhrsids[i]
-
-            # create an SQL statement and matching tuple of values to insert
-            values_list = []
-            sql = "INSERT INTO " + self.table_name + " VALUES ("
-            for key in record.keys():
-                if key == 'geog':
-                    sql += record['geog']
-                else:
-                    values_list.append(record[key])
-                    sql += "%s"
-                    # if not last key/value pair in record, add a comma
-                if (key != record.keys()[-1]):
-                    sql += ","
-            values = tuple(values_list)
-            sql += ")"
-
-            cur = connection.cursor()
-
-            try:
-                cur.execute(sql, values)
-            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
-                connection.rollback()
-                print "\nCouldn't insert the following OSM data:"
-                print record
-                print "The reason given was:"
-                print repr(e)
-                print "Continuing..."
-            else:
-                connection.commit()
-
+            row[4] = i
+            row[fhrsid_pos] = fhrsids[i]
+            rows.append(tuple(row))
+        return rows
 
-    def write_result_nodes_and_ways(self, result, connection, filter_ways=True):
+    def write_result_nodes_and_ways(self, result, connection, filter_ways=True,
+                                    upsert=False, reject_filename=None):
         """Filter the OSM nodes and ways from the query result and write
         matching entities to the database
 
         result (object): result object from query
         connection (object): database connection
         filter_ways (boolean): do we need to filter ways based on tag/value list?
+        upsert (boolean): update existing entities in place if they have
+            changed and delete any which aren't in the result, rather than
+            assuming the table is empty?
+        reject_filename (string): file to which entities which can't be
+            inserted are appended (printed if None)
         """
 
+        loader = self.get_loader(connection, upsert=upsert,
+                                 reject_filename=reject_filename)
+
         # nodes could be relevant or just contain geometry info for a way
         # so in any case we need to filter them based on our tag_value_list
         for node in result.get_nodes():
-            # iterate through this node's tags/values
-            for tag, value in node.tags.iteritems():
-                # if this tag/value or tag match our criteria
-                if {'t': tag, 'v': value} in self.tag_value_list or tag in self.tag_exists_list:
-                    # write to DB and stop checking this node's tags/values
-                    self.write_entity(entity=node, lat=node.lat, lon=node.lon, connection=connection)
-                    break
+            # if this node's tags match our criteria, write to DB
+            if self.tags_match(node.tags):
+                self.write_entity(entity=node, lat=node.lat, lon=node.lon,
+                                  connection=connection, loader=loader)
 
         for way in result.get_ways():
-            # if filter_ways is True:
-            # iterate through this way's tags/values
-            for tag, value in way.tags.iteritems():
-                # if this tag/value or tag match our criteria
-                if {'t': tag, 'v': value} in self.tag_value_list or tag in self.tag_exists_list:
-                    # write to DB and stop checking this way's tags/values
-                    centroid = self.get_way_centroid(way)
-                    self.write_entity(entity=way, lat=centroid['lat'],
-                                      lon=centroid['lon'], connection=connection)
-                    break
-            # else:
-            #     centroid = self.get_way_centroid(way)
-            #     self.write_entity(entity=way, lat=centroid['lat'],
-            #                       lon=centroid['lon'], connection=connection)
+            # if this way's tags match our criteria, write to DB
+            if self.tags_match(way.tags):
+                centroid = self.get_way_centroid(way)
+                self.write_entity(entity=way, lat=centroid['lat'],
+                                  lon=centroid['lon'], connection=connection,
+                                  loader=loader)
 
         for relation in result.get_relations():
             if filter_ways is True:
-                for tag, value in relation.tags.iteritems():
-                    # if this tag/value or tag match our criteria
-                    if {'t': tag, 'v': value} in self.tag_value_list or tag in self.tag_exists_list:
-                        # write to DB and stop checking this relation's tags/values
-                        centroid = self.get_relation_centroid(relation)
-                        self.write_entity(entity=relation, lat=centroid['lat'],
-                                      lon=centroid['lon'], connection=connection)
-                        break
+                # if this relation's tags match our criteria, write to DB
+                if self.tags_match(relation.tags):
+                    centroid = self.get_relation_centroid(relation)
+                    self.write_entity(entity=relation, lat=centroid['lat'],
+                                      lon=centroid['lon'], connection=connection,
+                                      loader=loader)
             else:
                 centroid = self.get_relation_centroid(relation)
                 self.write_entity(entity=relation, lat=centroid['lat'],
-                                  lon=centroid['lon'], connection=connection)
+                                  lon=centroid['lon'], connection=connection,
+                                  loader=loader)
+
+        self.finish_writing(connection, loader, upsert=upsert)
+
+    def write_elements(self, elements, connection, filter_ways=True, upsert=False,
+                       node_store=None, reject_filename=None, coverage=None):
+        """Write matching OSM entities to the database from a stream of
+        elements, in the order nodes, ways, relations as in OSM XML. Only
+        the positions of nodes (in a NodeLocationStore) and the bounding
+        boxes of ways are kept, so that ways and relations can be located.
+        Nodes and ways may be interleaved (e.g. one tile after another), as
+        long as each node comes before the ways which use it, but every way
+        must come before the relations which contain it.
+
+        elements (iterable of objects): OSMElement objects as yielded by
+            iter_xml_elements
+        connection (object): database connection
+        filter_ways (boolean): do we need to filter relations based on
+            tag/value list? (see write_result_nodes_and_ways)
+        upsert (boolean): update existing entities in place if they have
+            changed and delete any which aren't in the data, rather than
+            assuming the table is empty?
+        node_store (object): NodeLocationStore to which node positions are
+            added, or from which they are read if it is read only
+        reject_filename (string): file to which entities which can't be
+            inserted are appended (printed if None)
+        coverage (object): CoverageGrid outside of which entities aren't
+            written, unless they have an fhrs:id tag (all entities are
+            written if None)
+        Returns number of entities written
+        """
+
+        loader = self.get_loader(connection, upsert=upsert,
+                                 reject_filename=reject_filename)
+        if node_store is None:
+            node_store = NodeLocationStore()
+        way_bboxes = {}
+        # ways and relations are located in batches (see get_way_centroids)
+        ways = []
+        relations = []
+        written = 0
+
+        for element in elements:
+            if element.type == 'node':
+                if not node_store.read_only:
+                    node_store.add(element.id, element.lon, element.lat)
+                if (self.tags_match(element.tags) and
+                        self.in_coverage(element.tags, element.lon, element.lat, coverage)):
+                    self.write_entity(entity=element, lat=element.lat, lon=element.lon,
+                                      connection=connection, loader=loader)
+                    written += 1
+            elif element.type == 'way' and element.lat is not None:
+                # centre already calculated by Overpass API
+                if (self.tags_match(element.tags) and
+                        self.in_coverage(element.tags, element.lon, element.lat, coverage)):
+                    self.write_entity(entity=element, lat=element.lat, lon=element.lon,
+                                      connection=connection, loader=loader)
+                    written += 1
+            elif element.type == 'way':
+                if element.coords is not None:
+                    for node_id, coord in zip(element.nodes, element.coords):
+                        node_store.add(node_id, coord[0], coord[1])
+                ways.append(element)
+                if len(ways) >= self.centroid_batch_size:
+                    written += self.write_way_batch(ways, node_store, way_bboxes,
+                                                    connection, loader, coverage)
+                    ways = []
+            elif element.type == 'relation':
+                if filter_ways is True and not self.tags_match(element.tags):
+                    continue
+                if element.lat is not None:
+                    # centre already calculated by Overpass API
+                    if self.in_coverage(element.tags, element.lon, element.lat, coverage):
+                        self.write_entity(entity=element, lat=element.lat, lon=element.lon,
+                                          connection=connection, loader=loader)
+                        written += 1
+                    continue
+                # relations need the bounding boxes of all the ways so far
+                if len(ways) > 0:
+                    written += self.write_way_batch(ways, node_store, way_bboxes,
+                                                    connection, loader, coverage)
+                    ways = []
+                relations.append(element)
+                if len(relations) >= self.centroid_batch_size:
+                    written += self.write_relation_batch(relations, node_store, way_bboxes,
+                                                         connection, loader, coverage)
+                    relations = []
+
+        if len(ways) > 0:
+            written += self.write_way_batch(ways, node_store, way_bboxes,
+                                            connection, loader, coverage)
+        if len(relations) > 0:
+            written += self.write_relation_batch(relations, node_store, way_bboxes,
+                                                 connection, loader, coverage)
+
+        if written > 0:
+            self.finish_writing(connection, loader, upsert=upsert)
+        return written
+
+    def write_way_batch(self, ways, node_store, way_bboxes, connection, loader,
+                        coverage=None):
+        """Locate a batch of ways using their nodes' positions, record their
+        bounding boxes for use by relations and write those which match our
+        criteria to the database
+
+        ways (list of objects): OSMElement objects representing ways
+        node_store (object): NodeLocationStore containing node positions
+        way_bboxes (dict): bounding boxes (min lon, min lat, max lon,
+            max lat) keyed by way ID, to which the batch's are added
+        connection (object): database connection
+        loader (object): BulkLoader used to write the entities
+        coverage (object): CoverageGrid outside of which ways without an
+            fhrs:id tag aren't written
+        Returns number of entities written
+        """
+
+        node_ids = []
+        lengths = []
+        for way in ways:
+            node_ids.extend(way.nodes)
+            lengths.append(len(way.nodes))
+        lons, lats, found = node_store.lookup_all(node_ids)
+
+        # leave out nodes which couldn't be found, and any ways with no nodes
+        way_idx = numpy.repeat(numpy.arange(len(ways)), lengths)
+        counts = numpy.bincount(way_idx[found], minlength=len(ways))
+        lons = lons[found]
+        lats = lats[found]
+        located = counts > 0
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts[located])))
+
+        bboxes = zip(*[values.tolist() for values in self.get_bboxes(lons, lats, offsets)])
+        cent_lons, cent_lats = self.get_way_centroids(lons, lats, offsets)
+        if coverage is not None:
+            covered = coverage.contains_all(cent_lons, cent_lats)
+        cent_lons = cent_lons.tolist()
+        cent_lats = cent_lats.tolist()
+
+        written = 0
+        j = 0
+        for i, way in enumerate(ways):
+            if not located[i]:
+                print "Couldn't find the nodes for way " + str(way.id) + ". Continuing..."
+                continue
+            way_bboxes[way.id] = bboxes[j]
+            if (self.tags_match(way.tags) and
+                    (coverage is None or covered[j] or 'fhrs:id' in way.tags)):
+                self.write_entity(entity=way, lat=cent_lats[j], lon=cent_lons[j],
+                                  connection=connection, loader=loader)
+                written += 1
+            j += 1
+        return written
+
+    def write_relation_batch(self, relations, node_store, way_bboxes, connection, loader,
+                             coverage=None):
+        """Locate a batch of relations using the positions of their member
+        nodes and the bounding boxes of their member ways, and write them to
+        the database
+
+        relations (list of objects): OSMElement objects representing relations
+        node_store (object): NodeLocationStore containing node positions
+        way_bboxes (dict): bounding boxes of ways, keyed by way ID
+        connection (object): database connection
+        loader (object): BulkLoader used to write the entities
+        coverage (object): CoverageGrid outside of which relations without
+            an fhrs:id tag aren't written
+        Returns number of entities written
+        """
+
+        node_ids = []
+        for relation in relations:
+            for member_type, ref in relation.members:
+                if member_type == 'node':
+                    node_ids.append(ref)
+        node_lons, node_lats, found = node_store.lookup_all(node_ids)
+        node_lons = node_lons.tolist()
+        node_lats = node_lats.tolist()
+
+        # flatten the points for all the relations into a single list
+        lons = []
+        lats = []
+        offsets = [0]
+        k = 0
+        for relation in relations:
+            for member_type, ref in relation.members:
+                if member_type == 'node':
+                    if found[k]:
+                        lons.append(node_lons[k])
+                        lats.append(node_lats[k])
+                    k += 1
+                elif member_type == 'way' and ref in way_bboxes:
+                    bbox = way_bboxes[ref]
+                    lons.extend([bbox[0], bbox[2]])
+                    lats.extend([bbox[1], bbox[3]])
+            offsets.append(len(lons))
+
+        cent_lons, cent_lats = self.get_bbox_centres(lons, lats, offsets)
+        if coverage is not None:
+            covered = coverage.contains_all(cent_lons, cent_lats)
+        cent_lons = cent_lons.tolist()
+        cent_lats = cent_lats.tolist()
+        written = 0
+        for i, relation in enumerate(relations):
+            if (coverage is not None and not covered[i] and
+                    'fhrs:id' not in relation.tags):
+                continue
+            self.write_entity(entity=relation, lat=cent_lats[i], lon=cent_lons[i],
+                              connection=connection, loader=loader)
+            written += 1
+        return written
+
+    def finish_writing(self, connection, loader, upsert=False):
+        """Write any entities still buffered, delete any entities which
+        weren't written, if upserting, and make sure the OSM table is indexed
+
+        connection (object): database connection
+        loader (object): BulkLoader used to write the entities
+        upsert (boolean): were the entities upserted?
+        """
+        loader.flush()
+        print ("Wrote " + str(loader.loaded) + " rows to " + self.table_name + " (" +
+               str(loader.rejected) + " rejected)")
+        if upsert:
+            deleted = loader.delete_unseen()
+            print "Deleted " + str(deleted) + " OSM entities no longer in the data"
 
         cur = connection.cursor()
-        cur.execute('CREATE INDEX ON ' + self.table_name + ' USING GIST (geog);')
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + self.table_name + '_geog_idx\n' +
+                    'ON ' + self.table_name + ' USING GIST (geog);')
         connection.commit()
 
     def get_way_centroid(self, way):
@@ -1022,25 +3605,134 @@ class OSMDataset(object):
         way (object): overpy.Way object
         Returns dict of lat/lon
         """
-        # Polygon has to have at least 3 points
-        if len(way.nodes) >= 3:
-            geom = []
-            for node in way.nodes:
-                geom.append((node.lon, node.lat))
-            poly = Polygon(geom)
-            cent = poly.centroid
-            return {'lat': cent.y, 'lon': cent.x}
-        elif len(way.nodes) == 2:
-            # if way has 2 nodes, use average position
-            lat = (way.nodes[0].lat + way.nodes[1].lat) / 2
-            lon = (way.nodes[0].lon + way.nodes[1].lon) / 2
-            return {'lat': lat, 'lon': lon}
-        elif len(way.nodes) == 1:
-            # if way has 1 node, use that position
-            # (unusual and certainly a bug but possible)
-            return {'lat': way.nodes[0].lat, 'lon': way.nodes[0].lon}
-        else:
+        geom = []
+        for node in way.nodes:
+            geom.append((node.lon, node.lat))
+        return self.get_coords_centroid(geom)
+
+    def get_coords_centroid(self, coords):
+        """Calculate the centroid of a way from its nodes' positions
+
+        coords (list of tuples): (lon, lat) of each node
+        Returns dict of lat/lon
+        """
+        if len(coords) == 0:
             raise RuntimeError
+        lons, lats = self.get_way_centroids([coord[0] for coord in coords],
+                                            [coord[1] for coord in coords],
+                                            [0, len(coords)])
+        return {'lat': lats[0].item(), 'lon': lons[0].item()}
+
+    def get_way_centroids(self, lons, lats, offsets):
+        """Calculate the centroids of a batch of ways at once. The positions
+        of all the ways' nodes are given in two flat arrays, with the nodes
+        of way i at positions offsets[i] to offsets[i+1]-1. The result is
+        the same as that of a shapely Polygon's centroid for ways with at
+        least 3 nodes (falling back to the centroid of the outline, then of
+        the points, if the area is zero), the average position for ways with
+        2 nodes and the node's position for ways with 1 node.
+
+        lons/lats (lists or numpy arrays of decimals): positions of nodes
+        offsets (list or numpy array of integers): index of each way's first
+            node, followed by the total number of nodes
+        Returns tuple of numpy arrays of decimals (lons, lats)
+        """
+
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        starts = offsets[:-1]
+        ends = offsets[1:] - 1
+        counts = numpy.diff(offsets)
+        if numpy.any(counts < 1):
+            raise RuntimeError("Can't calculate the centroid of a way with no nodes")
+        num_ways = len(counts)
+        way_idx = numpy.repeat(numpy.arange(num_ways), counts)
+
+        # average position of nodes (used for ways with 1 or 2 nodes)
+        mean_lons = numpy.bincount(way_idx, weights=lons, minlength=num_ways) / counts
+        mean_lats = numpy.bincount(way_idx, weights=lats, minlength=num_ways) / counts
+
+        # shift each way's origin to its first node to reduce rounding error,
+        # and pair each node with the next, wrapping round to the first node
+        x = lons - lons[starts][way_idx]
+        y = lats - lats[starts][way_idx]
+        next_idx = numpy.arange(len(x)) + 1
+        next_idx[ends] = starts
+        next_x = x[next_idx]
+        next_y = y[next_idx]
+
+        # area-weighted centroid using the shoelace formula
+        cross = x * next_y - next_x * y
+        area2 = numpy.bincount(way_idx, weights=cross, minlength=num_ways)
+        area_x = numpy.bincount(way_idx, weights=(x + next_x) * cross, minlength=num_ways)
+        area_y = numpy.bincount(way_idx, weights=(y + next_y) * cross, minlength=num_ways)
+
+        # length-weighted centroid of outline, for polygons with no area
+        seg_length = numpy.hypot(next_x - x, next_y - y)
+        length = numpy.bincount(way_idx, weights=seg_length, minlength=num_ways)
+        line_x = numpy.bincount(way_idx, weights=seg_length * (x + next_x) / 2,
+                                minlength=num_ways)
+        line_y = numpy.bincount(way_idx, weights=seg_length * (y + next_y) / 2,
+                                minlength=num_ways)
+
+        cent_lons = mean_lons.copy()
+        cent_lats = mean_lats.copy()
+        polygon = (counts >= 3) & (area2 != 0)
+        line = (counts >= 3) & (area2 == 0) & (length > 0)
+        origin_lons = lons[starts]
+        origin_lats = lats[starts]
+        cent_lons[polygon] = (origin_lons[polygon] +
+                              area_x[polygon] / (3 * area2[polygon]))
+        cent_lats[polygon] = (origin_lats[polygon] +
+                              area_y[polygon] / (3 * area2[polygon]))
+        cent_lons[line] = origin_lons[line] + line_x[line] / length[line]
+        cent_lats[line] = origin_lats[line] + line_y[line] / length[line]
+        return cent_lons, cent_lats
+
+    def get_bboxes(self, lons, lats, offsets):
+        """Calculate the bounding boxes of a batch of sets of points at once,
+        given in the same way as for get_way_centroids. The bounding box of
+        an empty set of points is NaN.
+
+        lons/lats (lists or numpy arrays of decimals): positions of points
+        offsets (list or numpy array of integers): index of each set's first
+            point, followed by the total number of points
+        Returns tuple of numpy arrays of decimals
+            (min lons, min lats, max lons, max lats)
+        """
+
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        counts = numpy.diff(offsets)
+        bboxes = []
+        for values, reduce_func in ((lons, numpy.minimum), (lats, numpy.minimum),
+                                    (lons, numpy.maximum), (lats, numpy.maximum)):
+            result = numpy.empty(len(counts), dtype=numpy.float64)
+            result.fill(numpy.nan)
+            # reduceat doesn't work for empty sets, so leave them out
+            nonempty = counts > 0
+            if numpy.any(nonempty):
+                result[nonempty] = reduce_func.reduceat(values[:offsets[-1]],
+                                                        offsets[:-1][nonempty])
+            bboxes.append(result)
+        return tuple(bboxes)
+
+    def get_bbox_centres(self, lons, lats, offsets):
+        """Calculate the centres of the bounding boxes of a batch of sets of
+        points at once, given in the same way as for get_way_centroids. The
+        centre of an empty set of points is (0, 0).
+
+        lons/lats (lists or numpy arrays of decimals): positions of points
+        offsets (list or numpy array of integers): index of each set's first
+            point, followed by the total number of points
+        Returns tuple of numpy arrays of decimals (lons, lats)
+        """
+        min_lons, min_lats, max_lons, max_lats = self.get_bboxes(lons, lats, offsets)
+        cent_lons = numpy.nan_to_num(0.5 * (min_lons + max_lons))
+        cent_lats = numpy.nan_to_num(0.5 * (min_lats + max_lats))
+        return cent_lons, cent_lats
 
     def get_relation_centroid(self, relation):
         """Calculate a representative centre-point for a relation
@@ -1057,13 +3749,18 @@ class OSMDataset(object):
             elif isinstance(member, overpy.RelationNode):
                 node = member.resolve()
                 geom.append((node.lon, node.lat))
+        return self.get_bbox_centre(geom)
 
-        if len(geom) > 0:
-            mp = MultiPoint(geom)
-            bbox = mp.bounds
-            return {'lat': 0.5*(bbox[1]+bbox[3]), 'lon': 0.5*(bbox[0]+bbox[2])}
-        else:
-            return {'lat': 0, 'lon': 0}
+    def get_bbox_centre(self, coords):
+        """Calculate the centre of the bounding box of a list of points
+
+        coords (list of tuples): (lon, lat) of each point
+        Returns dict of lat/lon
+        """
+        lons, lats = self.get_bbox_centres([coord[0] for coord in coords],
+                                           [coord[1] for coord in coords],
+                                           [0, len(coords)])
+        return {'lat': lats[0].item(), 'lon': lons[0].item()}
 
 
 class FHRSDataset(object):
@@ -1071,8 +3768,15 @@ class FHRSDataset(object):
 
     api_base_url (string): base url for FHRS API
     api_headers (list of tuples): headers to add to HTTP request
+    http_pool (object): HTTPConnectionPool shared by all downloads
+    cache (object): ResponseCache for API responses, or None
     xmlns (string): namespace which prefixes tags when parsed with ElementTree
     xmlns_meta (string): namespace which prefixes meta tags
+    rate_limiter (object): TokenBucket shared by all FHRS downloads in this
+        process
+    deadline (numeric): time (secs since epoch) after which no more requests
+        are attempted, or None
+    circuit_breaker (object): CircuitBreaker keyed by authority
     """
 
     api_base_url = 'http://api.ratings.food.gov.uk/'
@@ -1082,6 +3786,8 @@ class FHRSDataset(object):
                    ('user-agent', 'python-fhrs-osm')]
     xmlns = '{http://schemas.datacontract.org/2004/07/FHRS.Model.Detailed}'
     xmlns_meta = '{http://schemas.datacontract.org/2004/07/FHRS.Model.MetaLinks}'
+    rate_limiter = TokenBucket(rate=10, capacity=10)
+    district_index = None # DistrictIndex used to tag establishments with their district
 
     def __init__(self,
                  est_field_list=[{'name': 'BusinessName', 'format': 'VARCHAR(100)'},
@@ -1091,108 +3797,281 @@ class FHRSDataset(object):
                                  {'name': 'AddressLine4', 'format': 'VARCHAR(100)'},
                                  {'name': 'PostCode', 'format': 'CHAR(10)'}],
                  auth_field_list=[{'name': 'Name', 'format': 'VARCHAR(100)'},
-                                  {'name': 'RegionName', 'format': 'VARCHAR(100)'}],
-                 est_table_name='fhrs_establishments', auth_table_name='fhrs_authorities'):
+                                  {'name': 'RegionName', 'format': 'VARCHAR(100)'},
+                                  {'name': 'LastPublishedDate', 'format': 'TIMESTAMP'}],
+                 est_table_name='fhrs_establishments', auth_table_name='fhrs_authorities',
+                 watermark_table_name='fhrs_watermarks', journal_table_name='fhrs_load_journal',
+                 api_base_url=None, cache=None, deadline_secs=None):
         """Constructor
 
         est_field_list (list of dicts): field/format dicts for establishment DB fields
         auth_field_list (list of dicts): field/format dicts for authority DB fields
         est_table_name (string): database table name to use for storing establishments
         auth_table_name (string): database table name to use for storing authorities
+        watermark_table_name (string): database table name to use for storing
+            the LastPublishedDate of each authority's data when it was loaded
+        journal_table_name (string): database table name to use for recording
+            which pages of establishments have been written during a load
+        api_base_url (string): if supplied, use instead of the default API
+            base url e.g. for a local test server
+        cache (object): if supplied, ResponseCache to use for API responses
+        deadline_secs (numeric): if supplied, stop making requests this many
+            seconds after the dataset is created
         """
+        self.cache = cache
+        if deadline_secs is not None:
+            self.deadline = time() + deadline_secs
+        else:
+            self.deadline = None
+        self.circuit_breaker = CircuitBreaker()
+        if api_base_url is not None:
+            self.api_base_url = api_base_url
+        # persistent connections shared by all download threads
+        self.http_pool = HTTPConnectionPool()
         # list of field/format dicts representing database fields
         self.est_field_list = est_field_list
         self.auth_field_list = auth_field_list
         # database table name to use for storing FHRS establishments
         self.est_table_name = est_table_name
         self.auth_table_name = auth_table_name
+        self.watermark_table_name = watermark_table_name
+        self.journal_table_name = journal_table_name
 
-    def api_download(self, endpoint, max_attempts = 7, first_sleep_time = 3):
+    def api_open(self, endpoint, max_attempts = 7, first_sleep_time = 3,
+                 max_sleep_time = 60, revalidate=False, breaker_key=None):
         """
-        Use the FHRS API to download XML data. If first attempt fails, wait
-        and try again. The sleep time progressively increases using the
-        formula first_sleep_time ** attempt.
+        Use the FHRS API to request XML data (see api_request), using our
+        cache if we have one.
+
+        A cached response is used without a request while it is fresh, and
+        revalidated with a conditional request once it is stale. If the
+        server can't be reached to revalidate it, the cached response is
+        used anyway. New responses are streamed to the caller and added to
+        the cache once they have been read to the end (see CachingResponse).
+        In offline mode, only cached responses are used.
 
         endpoint (string): endpoint part of URL
         max_attempts (integer): max number of attempts
-        first_sleep_time (integer): sleep time (secs) after 1st bad attempt
+        first_sleep_time (numeric): max sleep time (secs) after 1st bad attempt
+        max_sleep_time (numeric): cap on max sleep time (secs)
+        revalidate (boolean): revalidate a cached response even if it is fresh?
+        breaker_key (string): circuit breaker key e.g. 'authority 371'
 
-        Returns XML string
+        Returns file-like response object from which XML can be read
         """
-        url = self.api_base_url + endpoint
-        request = urllib2.Request(url)
-        for header, content in self.api_headers:
-            request.add_header(header, content)
+        headers = list(self.api_headers)
+
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(endpoint)
+            if cached is not None and (self.cache.offline or
+                                       (cached['fresh'] and not revalidate)):
+                return cached['file']
+            if self.cache.offline:
+                raise RuntimeError("No cached response for " + endpoint +
+                                   " and the cache is in offline mode")
+            if cached is not None and cached['etag']:
+                headers.append(('if-none-match', cached['etag']))
+            if cached is not None and cached['last_modified']:
+                headers.append(('if-modified-since', cached['last_modified']))
+
+        try:
+            response = self.api_request(endpoint, headers, max_attempts, first_sleep_time,
+                                        max_sleep_time, breaker_key)
+        except (urllib2.URLError, socket.error, httplib.HTTPException,
+                FHRSAPIError) as e:
+            code = getattr(e, 'code', None)
+            if cached is not None and (code is None or code >= 500 or code in (408, 429)):
+                print "Couldn't revalidate cached response, so using it anyway"
+                return cached['file']
+            if cached is not None:
+                cached['file'].close()
+            raise
+
+        if self.cache is None:
+            return response
+        if response.status == 304:
+            response.read()
+            response.close()
+            self.cache.touch(endpoint)
+            return cached['file']
+        if cached is not None:
+            cached['file'].close()
+        return CachingResponse(self.cache, endpoint, response)
+
+    def api_request(self, endpoint, headers, max_attempts = 7, first_sleep_time = 3,
+                    max_sleep_time = 60, breaker_key=None):
+        """
+        Make a request to the FHRS API. If first attempt fails, wait and try
+        again. The sleep time is chosen at random up to a limit which doubles
+        after each attempt, starting at first_sleep_time and capped at
+        max_sleep_time, unless the server sends a longer Retry-After. Client
+        errors other than 408 and 429 aren't retried.
+
+        All requests in this process share a rate limiter, and no request or
+        sleep goes beyond our deadline. If breaker_key is supplied, repeated
+        failed requests for that key (each counted once all of its attempts
+        have failed) open a circuit breaker so that later requests for it
+        fail immediately.
+
+        endpoint (string): endpoint part of URL
+        headers (list of tuples): headers to add to HTTP request
+        max_attempts (integer): max number of attempts
+        first_sleep_time (numeric): max sleep time (secs) after 1st bad attempt
+        max_sleep_time (numeric): cap on max sleep time (secs)
+        breaker_key (string): circuit breaker key e.g. 'authority 371'
 
+        Returns PooledResponse object
+        """
+        url = self.api_base_url + endpoint
         attempt = 0
         while attempt < max_attempts:
             attempt += 1
+            if breaker_key is not None:
+                self.circuit_breaker.check(breaker_key)
+            self.rate_limiter.acquire(deadline=self.deadline)
             try:
-                response = urllib2.urlopen(request)
+                response = self.http_pool.request(url, headers)
                 break # exit while loop if successful
-            except:
+            except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
                 print "Error when trying to get data from FHRS API"
                 print "URL: " + url
-                print "Headers: " + repr(request.header_items())
-                if attempt == max_attempts: # final attempt
+                print "Headers: " + repr(self.api_headers)
+                print "Error: " + str(e)
+                code = getattr(e, 'code', None)
+                if code is not None and code < 500 and code not in (408, 429):
+                    pass # client error which won't go away by retrying
+                elif attempt == max_attempts: # final attempt
                     print "Exception from final attempt:"
-                    raise
                 else:
                     # wait before trying again
-                    sleep_time = first_sleep_time ** attempt
-                    print "Sleeping {} secs before next attempt".format(
-                        sleep_time
-                    )
-                    sleep(sleep_time)
+                    sleep_time = random.uniform(
+                        0, min(max_sleep_time, first_sleep_time * 2 ** (attempt - 1)))
+                    if code is not None:
+                        sleep_time = max(sleep_time, self.get_retry_after(e.hdrs))
+                    if self.deadline is None or time() + sleep_time <= self.deadline:
+                        print "Sleeping {:.1f} secs before next attempt".format(
+                            sleep_time
+                        )
+                        sleep(sleep_time)
+                        continue
+                    raise FHRSDeadlineError("Not enough time before deadline for " +
+                                            "another attempt after error: " + str(e))
+                # giving up on this request, which counts as one failure
+                if breaker_key is not None and self.circuit_breaker.record_failure(breaker_key):
+                    print "Too many failures for " + breaker_key + ". Giving up for now."
+                raise
+
+        if breaker_key is not None:
+            self.circuit_breaker.record_success(breaker_key)
+
+        return response
+
+    def get_retry_after(self, headers):
+        """Return the number of seconds we have been asked to wait by a
+        Retry-After header, which may contain seconds or an HTTP date
+
+        headers (object): response headers (mimetools.Message)
+        Returns numeric (0 if there is no valid Retry-After header)
+        """
+        value = headers.getheader('retry-after') if headers is not None else None
+        if not value:
+            return 0
+        try:
+            return max(0, float(value))
+        except ValueError:
+            date = parsedate_tz(value)
+            if date is None:
+                return 0
+            return max(0, mktime_tz(date) - time())
 
-        return response.read()
+    def api_download(self, endpoint, max_attempts = 7, first_sleep_time = 3,
+                     revalidate=False):
+        """Calls api_open to download XML data from the FHRS API
 
-    def download_authorities(self):
-        """Calls api_download to download authorities
+        endpoint (string): endpoint part of URL
+        max_attempts (integer): max number of attempts
+        first_sleep_time (integer): sleep time (secs) after 1st bad attempt
+        revalidate (boolean): revalidate a cached response even if it is fresh?
 
         Returns XML string
         """
-        return self.api_download('Authorities')
+        response = self.api_open(endpoint, max_attempts, first_sleep_time,
+                                 revalidate=revalidate)
+        try:
+            return response.read()
+        finally:
+            response.close()
 
-    def download_establishments_for_authority(self, authority_id=371):
-        """Calls api_download to download establishments for a single authority
+    def download_authorities(self):
+        """Calls api_download to download authorities. Any cached response is
+        always revalidated because we rely on the authorities' last published
+        dates to tell us which establishments have changed.
 
-        authority_id (integer): ID of authority
         Returns XML string
         """
+        return self.api_download('Authorities', revalidate=True)
 
-        page = 1
-        total_pages = 1 # assume 1 page for now
-        xml_list = [] # list to hold xml strings
+    def stream_establishments_for_authority(self, authority_id=371, max_workers=4,
+                                            skip_pages=None, revalidate=False):
+        """Download and parse establishments for a single authority, one page
+        at a time. Each page is parsed as it is read from the HTTP response,
+        so XML pages are never held in memory. The first page tells us the
+        total number of pages, after which up to max_workers of the remaining
+        pages are downloaded concurrently.
 
-        # if this is the first page or there is another to download
-        while (page == 1 or page <= total_pages):
-            # download this page (max 200 establishments) and add to list
+        authority_id (integer): ID of authority
+        max_workers (integer): max number of pages to download at once
+        skip_pages (set of integers): if supplied, pages not to yield (or to
+            download, apart from the first page)
+        revalidate (boolean): revalidate cached pages even if they are fresh,
+            e.g. because the authority has published new data? (see api_open)
+        Yields tuple (page, total_pages, list of rows) for each page in page
+            order, where rows are as described in iter_establishment_rows
+        """
+        if skip_pages is None:
+            skip_pages = set()
+
+        def download_page(page, meta=None):
+            # download and parse this page (max 200 establishments)
             endpoint = ('Establishments?localAuthorityId=' + str(authority_id) +
-                        '&pageNumber=' + str(page) + '&pageSize=200') 
-            xml_list.append(self.api_download(endpoint=endpoint))
-            if (page == 1):
-                # after the first page has been downloaded, get total number of pages
-                root = xml.etree.ElementTree.fromstring(xml_list[page - 1])
-                total_pages = int(root.findtext(self.xmlns_meta + 'meta/' +
-                                                self.xmlns_meta + 'totalPages'))
-            page += 1
-
-        return xml_list
-
-    def create_authority_table(self, connection):
+                        '&pageNumber=' + str(page) + '&pageSize=200')
+            response = self.api_open(endpoint=endpoint, revalidate=revalidate,
+                                     breaker_key='authority ' + str(authority_id))
+            try:
+                return list(self.iter_establishment_rows(response, meta=meta))
+            finally:
+                response.close()
+
+        # after the first page has been parsed, get total number of pages
+        meta = {}
+        rows = download_page(1, meta=meta)
+        total_pages = int(meta['totalPages'])
+        if 1 not in skip_pages:
+            yield 1, total_pages, rows
+
+        # download any remaining pages using a pool of worker threads
+        pages = [page for page in range(2, total_pages + 1) if page not in skip_pages]
+        for page, rows in zip(pages, _thread_imap(download_page, pages,
+                                                  max_workers=max_workers)):
+            yield page, total_pages, rows
+
+    def create_authority_table(self, connection, if_not_exists=False):
         """(Re)create the FHRS authority table, first dropping any existing
         table with the same name and any views dependent on it.
 
         connection (object): database connection object
+        if_not_exists (boolean): keep the existing table if there is one,
+            adding any columns it is missing?
         """
 
         cur = connection.cursor()
-        cur.execute('drop table if exists ' + self.auth_table_name + ' cascade')
-        connection.commit()
+        if not if_not_exists:
+            cur.execute('drop table if exists ' + self.auth_table_name + ' cascade')
+            connection.commit()
 
         # N.B. field names case sensitive because surrounded by ""
-        sql = ('CREATE TABLE ' + self.auth_table_name + '\n' +
+        sql = ('CREATE TABLE IF NOT EXISTS ' + self.auth_table_name + '\n' +
                '("LocalAuthorityId" SMALLINT PRIMARY KEY, "LocalAuthorityIdCode" SMALLINT UNIQUE,\n')
         for this_field in self.auth_field_list:
             sql += '"' + this_field['name'] + '" ' + this_field['format']
@@ -1200,36 +4079,54 @@ class FHRSDataset(object):
                 sql += ', '
         sql += ')'
         cur.execute(sql)
+
+        # add any columns missing from a table created by an older version
+        for this_field in self.auth_field_list:
+            cur.execute('ALTER TABLE ' + self.auth_table_name + '\n' +
+                        'ADD COLUMN IF NOT EXISTS "' + this_field['name'] + '" ' +
+                        this_field['format'])
         connection.commit()
 
-    def create_establishment_table(self, connection):
+    def create_establishment_table(self, connection, if_not_exists=False):
         """(Re)create the FHRS establishment table, first dropping any existing
         table with the same name and any views dependent on it.
 
         connection (object): database connection object
+        if_not_exists (boolean): keep the existing table (and its data,
+            indexes and dependent views) if there is one, adding any
+            columns it is missing?
         """
 
         cur = connection.cursor()
-        cur.execute('drop table if exists ' + self.est_table_name + ' cascade')
-        connection.commit()
+        if not if_not_exists:
+            cur.execute('drop table if exists ' + self.est_table_name + ' cascade')
+            connection.commit()
 
         # N.B. field names case sensitive because surrounded by ""
-        sql = ('CREATE TABLE ' + self.est_table_name + '\n'
+        sql = ('CREATE TABLE IF NOT EXISTS ' + self.est_table_name + '\n'
                '("FHRSID" INT PRIMARY KEY, geog GEOGRAPHY(POINT, 4326),\n' +
                '"LocalAuthorityCode" SMALLINT REFERENCES ' +
                self.auth_table_name + '("LocalAuthorityIdCode")\n')
         for this_field in self.est_field_list:
             sql += ', "' + this_field['name'] + '" ' + this_field['format']
-        sql += ')'
-
+        sql += ', district_id SMALLINT, content_hash CHAR(32))'
         cur.execute(sql)
+
+        # add any columns missing from a table created by an older version
+        columns = [('"' + this_field['name'] + '"', this_field['format'])
+                   for this_field in self.est_field_list]
+        columns.extend([('district_id', 'SMALLINT'), ('content_hash', 'CHAR(32)')])
+        for column, column_format in columns:
+            cur.execute('ALTER TABLE ' + self.est_table_name + '\n' +
+                        'ADD COLUMN IF NOT EXISTS ' + column + ' ' + column_format)
         connection.commit()
 
-    def write_authorities(self, xml_string, connection):
+    def write_authorities(self, xml_string, connection, upsert=False):
         """Write the FHRS authorities from the XML string to the database
 
         xml_string (string): XML containing authority info
         connection (object): database connection
+        upsert (boolean): update any existing authorities with the same ID?
         """
 
         root = xml.etree.ElementTree.fromstring(xml_string)
@@ -1263,6 +4160,12 @@ class FHRSDataset(object):
                     sql += ","
             values = tuple(values_list)
             sql += ")"
+            if upsert:
+                updates = []
+                for key in record.keys()[1:]:
+                    updates.append('"' + key + '" = EXCLUDED."' + key + '"')
+                sql += (' ON CONFLICT ("LocalAuthorityId") DO UPDATE SET ' +
+                        ', '.join(updates))
 
             cur = connection.cursor()
 
@@ -1278,82 +4181,648 @@ class FHRSDataset(object):
             else:
                 connection.commit()
 
-    def write_establishments(self, xml_list, connection):
+    def get_establishment_columns(self):
+        """Return the names of the values in each row returned by
+        get_establishment_rows
+
+        Returns list of strings
+        """
+        columns = ['FHRSID', 'lon', 'lat', 'LocalAuthorityCode']
+        for this_field in self.est_field_list:
+            columns.append(this_field['name'])
+        if self.district_index is not None:
+            columns.append('district_id')
+        return columns
+
+    def iter_establishment_rows(self, source, meta=None):
+        """Parse the FHRS establishments from XML into rows of values, in the
+        order given by get_establishment_columns. The XML is parsed
+        incrementally and each establishment element is discarded once it
+        has been read, so memory use doesn't depend on the size of the XML.
+        Both API pages and the open data files published for each authority
+        (which use EstablishmentDetail, Geocode etc. without a namespace) can
+        be parsed.
+
+        source (file-like object): XML containing establishment info e.g. an
+            HTTP response or open data file
+        meta (dict): if supplied, filled with values from the XML's meta
+            element e.g. {'totalPages': '3'}
+        Yields tuple for each establishment
+        """
+
+        # map each tag to its position in the row so that each child element
+        # only needs to be looked at once
+        est_tags = (self.xmlns + 'establishment', 'EstablishmentDetail')
+        geocode_tags = (self.xmlns + 'geocode', 'Geocode')
+        meta_tag = self.xmlns_meta + 'meta'
+        positions = {self.xmlns + 'FHRSID': 0, 'FHRSID': 0,
+                     self.xmlns + 'longitude': 1, 'Longitude': 1,
+                     self.xmlns + 'latitude': 2, 'Latitude': 2,
+                     self.xmlns + 'LocalAuthorityCode': 3, 'LocalAuthorityCode': 3}
+        for i, this_field in enumerate(self.est_field_list):
+            positions[self.xmlns + this_field['name']] = 4 + i
+            positions[this_field['name']] = 4 + i
+        row_length = 4 + len(self.est_field_list)
+
+        parents = []
+        for event, elem in xml.etree.cElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+
+            if elem.tag in est_tags:
+                row = [None] * row_length
+                for child in elem:
+                    if child.tag in geocode_tags:
+                        for coord in child:
+                            if coord.tag in positions:
+                                row[positions[coord.tag]] = coord.text or None
+                    elif child.tag in positions:
+                        row[positions[child.tag]] = child.text or None
+                # discard this establishment now that we've read it
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+                yield tuple(row)
+            elif elem.tag == meta_tag and meta is not None:
+                for child in elem:
+                    meta[child.tag.replace(self.xmlns_meta, '')] = child.text
+
+    def get_establishment_files(self, directory, authority_codes=None):
+        """Return the paths of FHRS open data XML files in a directory. Files
+        are published with names like FHRS760en-GB.xml, where 760 is the
+        authority's LocalAuthorityIdCode (not its LocalAuthorityId), so if
+        authority_codes is supplied, files named like this for other
+        authorities are left out.
+
+        directory (string): directory containing XML files
+        authority_codes (list of integers): if supplied, LocalAuthorityIdCodes
+            of authorities whose files we want (see get_authority_codes)
+        Returns sorted list of strings
+        """
+        filenames = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.lower().endswith('.xml'):
+                continue
+            match = re.match(r'FHRS(\d+)', filename, re.IGNORECASE)
+            if authority_codes is not None and match is not None:
+                if int(match.group(1)) not in authority_codes:
+                    continue
+            filenames.append(os.path.join(directory, filename))
+        return filenames
+
+    def stream_establishment_files(self, filenames, processes=None):
+        """Parse FHRS open data XML files in parallel using a pool of worker
+        processes. Each file is parsed incrementally, and only a few parsed
+        files are held waiting to be consumed at any one time.
+
+        filenames (list of strings): paths of XML files
+        processes (integer): number of worker processes (default: one per CPU)
+        Yields tuple (filename, list of rows) for each file in order, where
+            rows are as described in iter_establishment_rows
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        try:
+            pending = deque()
+            for filename in filenames:
+                pending.append(pool.apply_async(_parse_establishment_file,
+                                                ((self.est_field_list, filename),)))
+                if len(pending) >= processes * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def load_establishment_files(self, filenames, connection, processes=None,
+                                 bulk=False, reject_filename=None):
+        """Write the FHRS establishments from open data XML files to the
+        database, one batch per file. This is an alternative to downloading
+        them from the API, e.g. using a mirror of the files on local disk.
+
+        filenames (list of strings): paths of XML files
+        connection (object): database connection
+        processes (integer): number of worker processes used for parsing
+        bulk (boolean): load each file using COPY? (see write_establishment_rows)
+        reject_filename (string): file to which rejected establishments are
+            appended
+        Returns StageCounter object
+        """
+        write_stats = StageCounter('files')
+        for filename, rows in self.stream_establishment_files(filenames, processes):
+            print "Writing data from " + filename
+            start = time()
+            written = self.write_establishment_rows(rows, connection, bulk=bulk,
+                                                    reject_filename=reject_filename)
+            write_stats.add(busy_secs=time() - start, files=1, establishments=written)
+        return write_stats
+
+    def get_establishment_loader(self, connection, reject_filename=None,
+                                 upsert=False):
+        """Return a BulkLoader for writing rows of FHRS establishments
+
+        connection (object): database connection
+        reject_filename (string): file to which establishments which can't
+            be inserted are appended (printed if None)
+        upsert (boolean): update existing establishments with the same
+            FHRSID if their content has changed?
+        Returns BulkLoader object
+        """
+        if upsert:
+            upsert_key = ['FHRSID']
+        else:
+            upsert_key = None
+        return BulkLoader(connection, self.est_table_name,
+                          self.get_establishment_columns(),
+                          reject_filename=reject_filename,
+                          upsert_key=upsert_key, hash_column='content_hash')
+
+    def add_district_ids(self, rows):
+        """Add the ID of the district each FHRS establishment is in to the end
+        of its row, using district_index. Each authority's establishments
+        are usually in the same few districts, so these are tried first.
+
+        rows (iterable of tuples): rows as yielded by iter_establishment_rows
+        Yields tuple for each establishment
+        """
+        for row in rows:
+            yield row + (self.district_index.lookup(row[1], row[2], key=row[3]),)
+
+    def write_establishment_rows(self, rows, connection, bulk=False,
+                                 reject_filename=None, commit=True,
+                                 upsert=False):
+        """Write a batch of FHRS establishments to the database
+
+        rows (iterable of tuples): rows as yielded by iter_establishment_rows
+        connection (object): database connection
+        bulk (boolean): load the batch using COPY rather than inserting
+            establishments one at a time?
+        reject_filename (string): file to which establishments which can't
+            be inserted are appended (printed if None)
+        commit (boolean): commit the transaction once the batch is written?
+        upsert (boolean): update existing establishments with the same
+            FHRSID if their content has changed?
+        Returns number of establishments written
+        """
+
+        loader = self.get_establishment_loader(connection, reject_filename, upsert)
+        if self.district_index is not None:
+            rows = self.add_district_ids(rows)
+        if bulk:
+            return loader.load(list(rows), commit=commit)
+        written = loader.load_rows_singly(rows)
+        if commit:
+            connection.commit()
+        return written
+
+    def write_establishments(self, xml_list, connection, bulk=False,
+                             reject_filename=None):
         """Write the FHRS establishments from a list of XML strings to the database
 
         xml_list (list of strings): list of XML strings containing
             establishment info
         connection (object): database connection
+        bulk (boolean): load each page using COPY rather than inserting
+            establishments one at a time?
+        reject_filename (string): file to which establishments which can't
+            be inserted are appended (printed if None)
+        Returns number of establishments written
         """
 
+        written = 0
         for xml_string in xml_list: # i.e. for each page of results for this authority
+            written += self.write_establishment_rows(
+                self.iter_establishment_rows(StringIO(xml_string)), connection,
+                bulk=bulk, reject_filename=reject_filename)
+        return written
+
+    def create_journal_table(self, connection, reset=False):
+        """Create the table which records each page of establishments written
+        during a load, unless it already exists. Each page is recorded in the
+        same transaction as its establishments, so the table shows exactly
+        which work has been done and can be queried while a load is running.
+
+        connection (object): database connection
+        reset (boolean): remove all existing records e.g. at the start of a
+            new load?
+        """
+        cur = connection.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + self.journal_table_name + '\n' +
+                    '("LocalAuthorityId" SMALLINT, "Page" SMALLINT,\n' +
+                    '"TotalPages" SMALLINT NOT NULL, "Establishments" INT NOT NULL,\n' +
+                    '"WrittenAt" TIMESTAMP NOT NULL DEFAULT now(),\n' +
+                    '"LastPublishedDate" TIMESTAMP,\n' +
+                    'PRIMARY KEY ("LocalAuthorityId", "Page"))')
+        # journals created before LastPublishedDate was recorded
+        cur.execute('ALTER TABLE ' + self.journal_table_name + '\n' +
+                    'ADD COLUMN IF NOT EXISTS "LastPublishedDate" TIMESTAMP')
+        if reset:
+            cur.execute('TRUNCATE ' + self.journal_table_name)
+        connection.commit()
+
+    def record_journal(self, connection, authority_id, page, total_pages, establishments):
+        """Record that a page of establishments has been written, along with
+        the authority's current LastPublishedDate (page boundaries move when
+        an authority publishes new data). Doesn't commit, so that this can be
+        part of the same transaction as the establishments themselves.
+
+        connection (object): database connection
+        authority_id (integer): ID of authority
+        page (integer): page number
+        total_pages (integer): total number of pages for this authority
+        establishments (integer): number of establishments written
+        """
+        cur = connection.cursor()
+        sql = ('INSERT INTO ' + self.journal_table_name + '\n' +
+               '("LocalAuthorityId", "Page", "TotalPages", "Establishments",\n' +
+               '"LastPublishedDate")\n' +
+               'VALUES (%s, %s, %s, %s, (\n' +
+               '    SELECT "LastPublishedDate" FROM ' + self.auth_table_name + '\n' +
+               '    WHERE "LocalAuthorityId" = %s))\n' +
+               'ON CONFLICT ("LocalAuthorityId", "Page") DO UPDATE\n' +
+               'SET "TotalPages" = EXCLUDED."TotalPages",\n' +
+               '"Establishments" = EXCLUDED."Establishments", "WrittenAt" = now(),\n' +
+               '"LastPublishedDate" = EXCLUDED."LastPublishedDate"')
+        values = (authority_id, page, total_pages, establishments, authority_id)
+        cur.execute(sql, values)
+
+    def delete_journal_for_authority(self, connection, authority_id):
+        """Remove the journal records for an authority, e.g. once the pages
+        written for it have been deleted. Doesn't commit.
+
+        connection (object): database connection
+        authority_id (integer): ID of authority
+        """
+        cur = connection.cursor()
+        sql = ('DELETE FROM ' + self.journal_table_name + '\n' +
+               'WHERE "LocalAuthorityId" = %s')
+        values = (authority_id,)
+        cur.execute(sql, values)
+
+    def reset_republished_authorities(self, connection):
+        """Delete the establishments and journal records for authorities
+        which have published new data since their pages were written, as
+        the pages written no longer line up with the new ones. Resuming a
+        load then starts these authorities again from the first page.
+
+        connection (object): database connection
+        Returns list of IDs of authorities reset
+        """
+        cur = connection.cursor()
+        sql = ('SELECT DISTINCT j."LocalAuthorityId"\n' +
+               'FROM ' + self.journal_table_name + ' AS j\n' +
+               'LEFT JOIN ' + self.auth_table_name + ' AS auth\n' +
+               'ON j."LocalAuthorityId" = auth."LocalAuthorityId"\n' +
+               'WHERE j."LastPublishedDate" IS DISTINCT FROM auth."LastPublishedDate"\n' +
+               'ORDER BY j."LocalAuthorityId"')
+        cur.execute(sql)
+        authority_ids = []
+        for auth in cur.fetchall():
+            authority_ids.append(auth[0])
+        for authority_id in authority_ids:
+            self.delete_establishments_for_authority(connection, authority_id)
+            self.delete_journal_for_authority(connection, authority_id)
+        connection.commit()
+        return authority_ids
+
+    def get_journal_pages(self, connection):
+        """Return the pages recorded in the journal as written for each
+        authority whose load hasn't been completed
+
+        connection (object): database connection
+        Returns dict of sets of integers, keyed by authority ID
+        """
+        cur = connection.cursor()
+        sql = ('SELECT "LocalAuthorityId", "Page" FROM ' + self.journal_table_name + '\n' +
+               'WHERE "LocalAuthorityId" NOT IN (\n' +
+               '    SELECT "LocalAuthorityId" FROM ' + self.journal_table_name + '\n' +
+               '    GROUP BY "LocalAuthorityId"\n' +
+               '    HAVING COUNT(*) >= MAX("TotalPages"))')
+        cur.execute(sql)
+        pages = {}
+        for authority_id, page in cur.fetchall():
+            pages.setdefault(authority_id, set()).add(page)
+        return pages
+
+    def get_completed_authorities(self, connection):
+        """Return the authorities for which every page has been recorded in
+        the journal as written
+
+        connection (object): database connection
+        Returns list of integers
+        """
+        cur = connection.cursor()
+        sql = ('SELECT "LocalAuthorityId" FROM ' + self.journal_table_name + '\n' +
+               'GROUP BY "LocalAuthorityId"\n' +
+               'HAVING COUNT(*) >= MAX("TotalPages")\n' +
+               'ORDER BY "LocalAuthorityId"')
+        cur.execute(sql)
+        authority_ids = []
+        for auth in cur.fetchall():
+            authority_ids.append(auth[0])
+        return authority_ids
+
+    def get_load_progress(self, connection):
+        """Return a summary of the progress of a load from the journal. This
+        can be called using a separate connection while the load is running.
+
+        connection (object): database connection
+        Returns dict
+        """
+        cur = connection.cursor(cursor_factory=DictCursor)
+        sql = ('SELECT COUNT(*) AS authorities_started,\n' +
+               'COUNT(CASE WHEN pages >= total_pages THEN 1 END) AS authorities_completed,\n' +
+               'COALESCE(SUM(pages), 0) AS pages_written,\n' +
+               'COALESCE(SUM(total_pages), 0) AS pages_known,\n' +
+               'COALESCE(SUM(establishments), 0) AS establishments_written,\n' +
+               'MAX(last_written) AS last_written\n' +
+               'FROM (\n' +
+               '    SELECT COUNT(*) AS pages, MAX("TotalPages") AS total_pages,\n' +
+               '    SUM("Establishments") AS establishments, MAX("WrittenAt") AS last_written\n' +
+               '    FROM ' + self.journal_table_name + '\n' +
+               '    GROUP BY "LocalAuthorityId"\n' +
+               ') AS a')
+        cur.execute(sql)
+        return dict(cur.fetchone())
+
+    def download_and_write_establishments(self, authority_ids, connection,
+                                          download_threads=3, page_threads=4,
+                                          queue_size=20, bulk=False,
+                                          reject_filename=None,
+                                          replace_authorities=False,
+                                          skip_pages=None, upsert=False,
+                                          revalidate=False):
+        """Download and write establishments for several authorities, with
+        downloading and writing overlapped. Several authorities are
+        downloaded at once, page by page, into a bounded queue, which is
+        drained by a single writer using our database connection. When the
+        queue is full, the downloaders wait for the writer to catch up. Once
+        all of an authority's data has been written, its watermark is set.
+        Authorities which can't be downloaded from the API are skipped,
+        leaving their watermarks unchanged, and any of their pages which
+        have already been written are deleted. Each page written is recorded in
+        the journal table, so that an interrupted load can be resumed. Once
+        the deadline has passed, the authorities not yet loaded are left
+        unfinished, keeping any pages already written so that they can be
+        resumed.
+
+        If replace_authorities is True, each authority is downloaded in full
+        before being queued, and its existing establishments are replaced in
+        a single transaction. If upsert is True, each authority is also
+        downloaded in full, but only establishments which are new or have
+        changed are written and those which are missing are deleted, so the
+        amount written depends on how much the data has changed.
+
+        authority_ids (list of integers): IDs of authorities
+        connection (object): database connection
+        download_threads (integer): max number of authorities to download at once
+        page_threads (integer): max number of pages to download at once for
+            each authority
+        queue_size (integer): max number of downloaded pages waiting to be
+            written
+        bulk (boolean): load each page using COPY? (see write_establishment_rows)
+        reject_filename (string): file to which rejected establishments are
+            appended
+        replace_authorities (boolean): delete each authority's existing
+            establishments in the same transaction as writing the new ones?
+        skip_pages (dict of sets of integers): pages already written, keyed
+            by authority ID, which don't need to be written again
+        upsert (boolean): update each authority's existing establishments in
+            place, deleting any which are missing from its latest data?
+        revalidate (boolean): revalidate cached pages even if they are fresh?
+            Should be True when authorities are being loaded because their
+            LastPublishedDate has changed, so that old cached pages aren't
+            written with the new watermark.
+        Returns tuple of StageCounter objects (download, write)
+        """
 
-            root = xml.etree.ElementTree.fromstring(xml_string)
-
-            for est in root.iter(self.xmlns + 'establishment'):
-                # create a blank dict to store relevant data for this establishment
-                # need to keep it in order so we can write it to the database
-                record = OrderedDict()
-
-                # put FHRSID, position and LocalAuthorityCode into record dict
-                record['FHRSID'] = est.find(self.xmlns + 'FHRSID').text
-                record['geog'] = None
-                geocode = est.find(self.xmlns + 'geocode')
-                lon = geocode.find(self.xmlns + 'longitude').text
-                lat = geocode.find(self.xmlns + 'latitude').text
-                if lon is not None and lat is not None:
-                    record['geog'] = ("ST_GeogFromText('SRID=4326;POINT(" +
-                                      str(lon) + " " + str(lat) + ")')")
-                record['LocalAuthorityCode'] = est.find(self.xmlns + 'LocalAuthorityCode').text
-
-                # start with this record's other fields set to None
-                for this_field in self.est_field_list:
-                    record[this_field['name']] = None
-
-                # fill record dict from XML using field list
-                for this_field in self.est_field_list:
-                    if est.find(self.xmlns + this_field['name']).text is not None:
-                        record[this_field['name']] = est.find(self.xmlns + this_field['name']).text
-
-                # create an SQL statement and matching tuple of values to insert
-                values_list = []
-                sql = "INSERT INTO " + self.est_table_name + " VALUES ("
-                for key in record.keys():
-                    if key == 'geog' and record['geog'] is not None:
-                        sql += record['geog']
-                    else:
-                        values_list.append(record[key])
-                        sql += "%s"
-                    # if not last key/value pair in record, add a comma
-                    if (key != record.keys()[-1]):
-                        sql += ","
-                values = tuple(values_list)
-                sql += ")"
-
-                cur = connection.cursor()
+        download_stats = StageCounter('download')
+        write_stats = StageCounter('write')
+        todo = Queue.Queue()
+        for authority_id in authority_ids:
+            todo.put(authority_id)
+        done = Queue.Queue(maxsize=queue_size)
 
+        def downloader():
+            while True:
                 try:
-                    cur.execute(sql, values)
-                except (psycopg2.DataError, psycopg2.IntegrityError) as e:
-                    connection.rollback()
-                    print "\nCouldn't insert the following FHRS establishment data:"
-                    print record
-                    print "The reason given was:"
-                    print repr(e)
-                    print "Continuing..."
-                else:
+                    authority_id = todo.get_nowait()
+                except Queue.Empty:
+                    done.put(None) # tell the writer this downloader has finished
+                    return
+                try:
+                    start = time()
+                    all_rows = []
+                    skip = set()
+                    if skip_pages is not None:
+                        skip = skip_pages.get(authority_id, set())
+                    last_page = None
+                    for page, total_pages, rows in self.stream_establishments_for_authority(
+                            authority_id, max_workers=page_threads, skip_pages=skip,
+                            revalidate=revalidate):
+                        download_stats.add(busy_secs=time() - start, pages=1,
+                                           establishments=len(rows))
+                        if last_page is None:
+                            # find the last page we need to write
+                            last_page = total_pages
+                            while last_page in skip:
+                                last_page -= 1
+                        last = page == last_page
+                        if replace_authorities or upsert:
+                            # queue the whole authority as a single batch
+                            all_rows.extend(rows)
+                            if last:
+                                done.put((authority_id, 1, 1, all_rows, True, None))
+                        else:
+                            # blocks if queue is full
+                            done.put((authority_id, page, total_pages, rows, last, None))
+                        start = time()
+                    if last_page is None:
+                        # every page was written by an earlier run
+                        done.put((authority_id, None, None, None, True, None))
+                except Exception:
+                    # the writer decides whether to skip this authority, so
+                    # carry on with the rest (and still put our sentinel)
+                    done.put((authority_id, None, None, None, None, sys.exc_info()))
+                    continue
+                download_stats.add(authorities=1)
+
+        num_downloaders = max(1, min(download_threads, len(authority_ids)))
+        for i in range(num_downloaders):
+            thread = threading.Thread(target=downloader)
+            thread.daemon = True
+            thread.start()
+
+        # write each page as soon as it has been downloaded
+        finished = 0
+        while finished < num_downloaders:
+            item = done.get()
+            if item is None:
+                finished += 1
+                continue
+            authority_id, page, total_pages, rows, last, error = item
+            if error is not None:
+                print "Couldn't download data for authority " + str(authority_id)
+                exc_type, exc_value, exc_tb = error
+                if not issubclass(exc_type, (FHRSAPIError, urllib2.URLError,
+                                             socket.error, httplib.HTTPException)):
+                    raise exc_type, exc_value, exc_tb
+                print str(exc_value)
+                if issubclass(exc_type, FHRSDeadlineError):
+                    # keep the pages written so far for the next run to resume
+                    print "Leaving authority " + str(authority_id) + " unfinished."
+                    download_stats.add(unfinished_authorities=1)
+                    continue
+                # don't let one authority stop the others being loaded
+                print "Skipping authority " + str(authority_id) + ". Continuing..."
+                if not (replace_authorities or upsert):
+                    # pages already written would leave the authority half
+                    # loaded, so remove them (and their journal records)
+                    self.delete_establishments_for_authority(connection, authority_id)
+                    self.delete_journal_for_authority(connection, authority_id)
                     connection.commit()
+                download_stats.add(failed_authorities=1)
+                continue
+            if page is None:
+                # nothing left to write, so just mark the authority as loaded
+                self.set_watermark(connection, authority_id)
+                connection.commit()
+                write_stats.add(authorities=1)
+                continue
+            if page == 1:
+                print "Writing data for authority " + str(authority_id)
+            start = time()
+            if page == 1 and replace_authorities:
+                self.delete_establishments_for_authority(connection, authority_id)
+            written = self.write_establishment_rows(rows, connection, bulk=bulk,
+                                                    reject_filename=reject_filename,
+                                                    commit=False, upsert=upsert)
+            if upsert:
+                deleted = self.delete_missing_establishments(connection, authority_id)
+                write_stats.add(deleted=deleted)
+            self.record_journal(connection, authority_id, page, total_pages, written)
+            if last:
+                self.set_watermark(connection, authority_id)
+            connection.commit()
+            write_stats.add(busy_secs=time() - start, pages=1, establishments=written)
+            if last:
+                write_stats.add(authorities=1)
+
+        return download_stats, write_stats
 
     def create_fhrs_indexes(self, connection):
-        """Create database indexes for FHRS establishments table
+        """Create database indexes for FHRS establishments table, unless they
+        already exist
+
+        connection (object): database connection
+        """
+        cur = connection.cursor()
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + self.est_table_name + '_fhrsid_text_idx\n' +
+                    'ON ' + self.est_table_name + ' (CAST ("FHRSID" AS TEXT));')
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + self.est_table_name + '_geog_idx\n' +
+                    'ON ' + self.est_table_name + ' USING GIST (geog);')
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + self.est_table_name + '_authority_idx\n' +
+                    'ON ' + self.est_table_name + ' ("LocalAuthorityCode");')
+        connection.commit()
+
+    def create_watermark_table(self, connection, reset=False):
+        """Create the table which records the LastPublishedDate of each
+        authority's data at the time it was loaded, unless it already exists
 
         connection (object): database connection
+        reset (boolean): remove all existing watermarks?
         """
         cur = connection.cursor()
-        cur.execute('CREATE INDEX ON ' + self.est_table_name + ' (CAST ("FHRSID" AS TEXT));')
-        cur.execute('CREATE INDEX ON ' + self.est_table_name + ' USING GIST (geog);')
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + self.watermark_table_name + '\n' +
+                    '("LocalAuthorityId" SMALLINT PRIMARY KEY,\n' +
+                    '"LastPublishedDate" TIMESTAMP,\n' +
+                    '"LoadedAt" TIMESTAMP NOT NULL DEFAULT now())')
+        if reset:
+            cur.execute('TRUNCATE ' + self.watermark_table_name)
         connection.commit()
 
+    def set_watermark(self, connection, authority_id):
+        """Record the authority's current LastPublishedDate as the watermark
+        for its loaded data. Doesn't commit, so that this can be part of the
+        same transaction as the data itself.
+
+        connection (object): database connection
+        authority_id (integer): ID of authority
+        """
+        cur = connection.cursor()
+        sql = ('INSERT INTO ' + self.watermark_table_name + '\n' +
+               '("LocalAuthorityId", "LastPublishedDate", "LoadedAt")\n' +
+               'SELECT "LocalAuthorityId", "LastPublishedDate", now()\n' +
+               'FROM ' + self.auth_table_name + ' WHERE "LocalAuthorityId" = %s\n' +
+               'ON CONFLICT ("LocalAuthorityId") DO UPDATE\n' +
+               'SET "LastPublishedDate" = EXCLUDED."LastPublishedDate",\n' +
+               '"LoadedAt" = EXCLUDED."LoadedAt"')
+        values = (authority_id,)
+        cur.execute(sql, values)
+
+    def get_changed_authorities(self, connection, authority_ids):
+        """Return the authorities whose LastPublishedDate differs from the
+        watermark recorded when their data was last loaded, or which haven't
+        been loaded at all
+
+        connection (object): database connection
+        authority_ids (list of integers): IDs of authorities to check
+        Returns list of integers
+        """
+        if len(authority_ids) == 0:
+            return []
+        cur = connection.cursor()
+        sql = ('SELECT auth."LocalAuthorityId"\n' +
+               'FROM ' + self.auth_table_name + ' AS auth\n' +
+               'LEFT JOIN ' + self.watermark_table_name + ' AS wm\n' +
+               'ON auth."LocalAuthorityId" = wm."LocalAuthorityId"\n' +
+               'WHERE auth."LocalAuthorityId" IN %s\n' +
+               'AND (wm."LocalAuthorityId" IS NULL\n' +
+               '     OR auth."LastPublishedDate" IS DISTINCT FROM wm."LastPublishedDate")\n' +
+               'ORDER BY auth."LocalAuthorityId"')
+        values = (tuple(authority_ids),)
+        cur.execute(sql, values)
+        changed = []
+        for auth in cur.fetchall():
+            changed.append(auth[0])
+        return changed
+
+    def delete_missing_establishments(self, connection, authority_id):
+        """Delete the establishments for an authority which haven't been
+        written (in upsert mode) since this was last called, i.e. those
+        missing from its latest data. Doesn't commit, so that this can be
+        part of the same transaction as writing the latest data.
+
+        connection (object): database connection
+        authority_id (integer): ID of authority
+        Returns number of establishments deleted
+        """
+        loader = self.get_establishment_loader(connection, upsert=True)
+        where = ('target."LocalAuthorityCode" = (\n' +
+                 '    SELECT "LocalAuthorityIdCode" FROM ' + self.auth_table_name + '\n' +
+                 '    WHERE "LocalAuthorityId" = %s)')
+        values = (authority_id,)
+        return loader.delete_unseen(where, values)
+
+    def delete_establishments_for_authority(self, connection, authority_id):
+        """Delete the establishments for an authority. Doesn't commit, so that
+        new data for the authority can be loaded in the same transaction.
+
+        connection (object): database connection
+        authority_id (integer): ID of authority
+        """
+        cur = connection.cursor()
+        sql = ('DELETE FROM ' + self.est_table_name + '\n' +
+               'WHERE "LocalAuthorityCode" = (\n' +
+               '    SELECT "LocalAuthorityIdCode" FROM ' + self.auth_table_name + '\n' +
+               '    WHERE "LocalAuthorityId" = %s)')
+        values = (authority_id,)
+        cur.execute(sql, values)
+
     def get_authorities(self, connection, region_name=None):
         """Return a list of FHRS authority IDs (without those for Northern
         Ireland because OS Boundary Line does not cover Northern Ireland)
@@ -1376,6 +4845,27 @@ class FHRSDataset(object):
             authority_ids.append(auth[0])
         return authority_ids
 
+    def get_authority_codes(self, connection, authority_ids):
+        """Return the LocalAuthorityIdCodes of authorities, which are used in
+        the names of the FHRS open data files
+
+        connection (object): database connection
+        authority_ids (list of integers): IDs of authorities
+        Returns list of integers
+        """
+        if len(authority_ids) == 0:
+            return []
+        cur = connection.cursor()
+        sql = ('SELECT "LocalAuthorityIdCode" FROM ' + self.auth_table_name + '\n' +
+               'WHERE "LocalAuthorityId" IN %s\n' +
+               'ORDER BY "LocalAuthorityIdCode"')
+        values = (tuple(authority_ids),)
+        cur.execute(sql, values)
+        authority_codes = []
+        for auth in cur.fetchall():
+            authority_codes.append(auth[0])
+        return authority_codes
+
     def get_bbox(self, connection, region_name=None, authority_id=None):
         """Return a bounding box for FHRS establishments. If region_name is
         specified, filter establishments based on this. If authority_id is
@@ -1482,6 +4972,36 @@ class FHRSDataset(object):
 
         return values
 
+    def get_coverage(self, connection, cell_size=0.05, margin=0.01, min_establishments=1):
+        """Return the area covered by FHRS establishments as a grid of
+        cells, calculated using a single query. Unlike get_corrected_bbox,
+        areas between clusters of establishments (e.g. between the local
+        authorities of a region) aren't included.
+
+        connection (object): database connection
+        cell_size (decimal): width and height of cells in degrees
+        margin (decimal): distance in degrees around each cell which is
+            also covered (see CoverageGrid)
+        min_establishments (integer): min number of establishments in a
+            cell for it to be covered (can be used to ignore outliers)
+        Returns CoverageGrid object
+        """
+
+        coverage = CoverageGrid(cell_size=cell_size, margin=margin)
+        cur = connection.cursor()
+
+        sql = ('SELECT floor(ST_Y(geog::geometry) / %s) AS cell_row,\n' +
+               'floor(ST_X(geog::geometry) / %s) AS cell_col\n' +
+               'FROM ' + self.est_table_name + '\n' +
+               'WHERE geog IS NOT NULL\n' +
+               'GROUP BY cell_row, cell_col\n' +
+               'HAVING count(*) >= %s')
+        values = (cell_size, cell_size, min_establishments)
+        cur.execute(sql, values)
+        for row, col in cur.fetchall():
+            coverage.add_cell(row, col)
+        return coverage
+
     def get_corrected_bbox(self, connection, fence_multiplier=3):
         """Return a bounding box for FHRS establishments, ignoring outliers.
 
@@ -1530,3 +5050,20 @@ class FHRSDataset(object):
         e = cur.fetchone()[0]
 
         return [s,w,n,e]
+
+
+def _parse_establishment_file(args):
+    """Parse an FHRS open data XML file. This is a module-level function so
+    that it can be called in a worker process by
+    FHRSDataset.stream_establishment_files.
+
+    args (tuple): est_field_list and path of XML file
+    Returns tuple (filename, list of rows)
+    """
+    est_field_list, filename = args
+    f = open(filename, 'rb')
+    try:
+        fhrs = FHRSDataset(est_field_list=est_field_list)
+        return filename, list(fhrs.iter_establishment_rows(f))
+    finally:
+        f.close()
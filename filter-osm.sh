@@ -2,16 +2,9 @@
 
 source config.py
 
-filter_list="amenity=bar,cafe,care_home,childcare,church_hall,cinema,college,\
-community_centre,community_hall,fast_food,fuel,hospital,ice_cream,\
-kindergarten,nightclub,nursing_home,pharmacy,place_of_worship,post_office,pub,\
-restaurant,school,social_club,social_facility,theatre,village_hall \
-club=scouts,social,sport \
-craft=brewery,caterer,confectionery,distillery,winery \
-shop=alcohol,bakery,butcher,cheese,chemist,confectionery,convenience,deli,\
-delicatessen,discount,farm,fishmonger,greengrocer,grocery,health_food,\
-newsagent,pastry,seafood,supermarket,variety_store \
-tourism=hotel,guest_house"
+# generate the filter from the same tag lists as used by the Python code
+# e.g. "amenity=bar,cafe,... shop=alcohol,... fhrs:id=*"
+filter_list=$(python -c "from fhrs_osm import OSMDataset; print OSMDataset().tag_filter.get_osmosis_filter()") || exit 1
 
 if [ ! -d data ]
 then
@@ -19,39 +12,21 @@ then
 fi
 
 $osmosis_bin \
-  --read-pbf $input_pbf \
-  --tf accept-relations fhrs:id=* \
-  --used-way \
-  --used-node outPipe.0="relations-fhrsid" \
-  \
   --read-pbf $input_pbf \
   --tf accept-relations $filter_list \
   --used-way \
-  --used-node outPipe.0="relations-filter" \
-  \
-  --read-pbf $input_pbf \
-  --tf accept-ways fhrs:id=* \
-  --tf reject-relations \
-  --used-node outPipe.0="ways-fhrsid" \
+  --used-node outPipe.0="relations" \
   \
   --read-pbf $input_pbf \
   --tf accept-ways $filter_list \
   --tf reject-relations \
-  --used-node outPipe.0="ways-filter" \
-  \
-  --read-pbf $input_pbf \
-  --tf accept-nodes fhrs:id=* \
-  --tf reject-ways \
-  --tf reject-relations outPipe.0="nodes-fhrsid" \
+  --used-node outPipe.0="ways" \
   \
   --read-pbf $input_pbf \
   --tf accept-nodes $filter_list \
   --tf reject-ways \
-  --tf reject-relations outPipe.0="nodes-filter" \
+  --tf reject-relations outPipe.0="nodes" \
   \
-  --merge inPipe.0="relations-fhrsid" inPipe.1="relations-filter" \
-  --merge inPipe.0="ways-fhrsid" inPipe.1="ways-filter" \
-  --merge \
-  --merge inPipe.0="nodes-fhrsid" inPipe.1="nodes-filter" \
-  --merge \
+  --merge inPipe.0="relations" inPipe.1="ways" outPipe.0="relations-ways" \
+  --merge inPipe.0="relations-ways" inPipe.1="nodes" \
   --write-xml data/filtered.osm
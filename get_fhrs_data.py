@@ -5,14 +5,41 @@ db = Database(dbname=config.dbname)
 con = db.connect()
 
 # get FHRS data
-fhrs = FHRSDataset()
+if config.fhrs_cache_dir:
+    cache = ResponseCache(config.fhrs_cache_dir, ttl=config.fhrs_cache_ttl,
+                          max_bytes=config.fhrs_cache_max_mb * 1024 * 1024,
+                          offline=config.fhrs_cache_only)
+else:
+    cache = None
+FHRSDataset.rate_limiter = TokenBucket(rate=config.fhrs_requests_per_sec,
+                                       capacity=config.fhrs_requests_per_sec)
+fhrs = FHRSDataset(cache=cache, deadline_secs=config.fhrs_deadline_mins * 60)
+
+# read the load mode from the config file to work out whether we keep
+# existing data and which authorities need to be downloaded
+if (config.fhrs_load_mode == 'replace'):
+    keep_existing = False
+elif (config.fhrs_load_mode in ('incremental', 'upsert', 'resume')):
+    keep_existing = True
+else:
+    raise RuntimeError("Bad value for fhrs_load_mode in config.py\n"
+                       "Should be 'replace', 'incremental', 'upsert' or 'resume'")
+incremental = config.fhrs_load_mode in ('incremental', 'upsert')
+upsert = config.fhrs_load_mode == 'upsert'
+resume = config.fhrs_load_mode == 'resume'
+
+if config.tag_districts_on_ingest:
+    print "Loading district boundaries"
+    fhrs.district_index = DistrictIndex()
+    fhrs.district_index.load(connection=con, cache_filename=config.district_cache_file)
+
 print "Creating FHRS authority database table"
-fhrs.create_authority_table(connection=con)
+fhrs.create_authority_table(connection=con, if_not_exists=keep_existing)
 
 print "Getting data for FHRS authorities"
 xmlstring = fhrs.download_authorities()
 print "Writing data for FHRS authorities"
-fhrs.write_authorities(xmlstring, con)
+fhrs.write_authorities(xmlstring, con, upsert=keep_existing)
 print "Querying database for authority IDs"
 
 # read the mode from the config file to work out what will be downloaded
@@ -27,13 +54,60 @@ else:
                        "Should be 'small_test', 'west_mids' or 'full'")
 
 print "Creating FHRS establishment database table"
-fhrs.create_establishment_table(connection=con)
+fhrs.create_establishment_table(connection=con, if_not_exists=keep_existing)
+fhrs.create_watermark_table(connection=con, reset=not keep_existing)
+fhrs.create_journal_table(connection=con, reset=not resume)
+
+skip_pages = None
+if incremental:
+    fhrs.create_fhrs_indexes(connection=con)
+    fhrs_authorities = fhrs.get_changed_authorities(con, fhrs_authorities)
+    print str(len(fhrs_authorities)) + " FHRS authorities have published new data"
+elif resume:
+    republished = fhrs.reset_republished_authorities(con)
+    if len(republished) > 0:
+        print (str(len(republished)) + " FHRS authorities have published new data " +
+               "since the load was interrupted and will be loaded from the start")
+    completed = fhrs.get_completed_authorities(con)
+    fhrs_authorities = [a for a in fhrs_authorities if a not in completed]
+    skip_pages = fhrs.get_journal_pages(con)
+    print ("Resuming load: " + str(len(completed)) + " FHRS authorities already loaded, " +
+           str(len(fhrs_authorities)) + " to go")
+
+if (config.fhrs_source == 'files'):
+    if keep_existing:
+        raise RuntimeError("fhrs_load_mode must be 'replace' when fhrs_source is 'files'")
+    # files are named using the authorities' codes rather than their IDs
+    authority_codes = fhrs.get_authority_codes(con, fhrs_authorities)
+    filenames = fhrs.get_establishment_files(config.fhrs_files_dir,
+                                             authority_codes=authority_codes)
+    print "Reading data from " + str(len(filenames)) + " FHRS files"
+    files_stats = fhrs.load_establishment_files(
+        filenames, con,
+        bulk=config.fhrs_bulk_load,
+        reject_filename=config.fhrs_reject_file)
+    print files_stats.summary()
+elif (config.fhrs_source == 'api'):
+    download_stats, write_stats = fhrs.download_and_write_establishments(
+        fhrs_authorities, con,
+        download_threads=config.fhrs_authority_threads,
+        page_threads=config.fhrs_download_threads,
+        queue_size=config.fhrs_queue_size,
+        bulk=config.fhrs_bulk_load,
+        reject_filename=config.fhrs_reject_file,
+        replace_authorities=incremental and not upsert,
+        skip_pages=skip_pages, upsert=upsert,
+        revalidate=incremental)
+    print download_stats.summary()
+    print write_stats.summary()
+else:
+    raise RuntimeError("Bad value for fhrs_source in config.py\n"
+                       "Should be 'api' or 'files'")
 
-for this_authority in fhrs_authorities:
-    print "Getting data for authority " + str(this_authority)
-    xmllist = fhrs.download_establishments_for_authority(this_authority)
-    print "Writing data for authority " + str(this_authority)
-    fhrs.write_establishments(xmllist, con)
+http_counts = fhrs.http_pool.get_counts()
+print ("http: {requests} requests, {new_connections} connections, "
+       "{wire_bytes} bytes transferred ({compression_ratio:.1f}x compression), "
+       "{mean_latency_secs:.3f}s mean latency".format(**http_counts))
 
 print "Adding database indexes for FHRS establishments"
 fhrs.create_fhrs_indexes(connection=con)
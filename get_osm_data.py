@@ -1,28 +1,83 @@
 from fhrs_osm import *
 import config
+import os
 
 db = Database(dbname=config.dbname)
 con = db.connect()
 
 fhrs = FHRSDataset()
 osm = OSMDataset()
+osm.overpass_url = config.overpass_url
+
+if config.tag_districts_on_ingest:
+    print "Loading district boundaries"
+    osm.district_index = DistrictIndex()
+    osm.district_index.load(connection=con, cache_filename=config.district_cache_file)
+
+# read the load mode from the config file to work out whether we keep
+# existing data
+if (config.osm_load_mode == 'replace'):
+    upsert = False
+elif (config.osm_load_mode == 'upsert'):
+    upsert = True
+else:
+    raise RuntimeError("Bad value for osm_load_mode in config.py\n"
+                       "Should be 'replace' or 'upsert'")
 
 print "Creating OSM database table"
-osm.create_table(connection=con)
+osm.create_table(connection=con, if_not_exists=upsert)
+
+# work out where the FHRS establishments are, so that OSM data elsewhere
+# isn't downloaded or written
+coverage = None
+if config.coverage_cell_degrees:
+    print 'Calculating geographical coverage of FHRS data'
+    coverage = fhrs.get_coverage(connection=con, cell_size=config.coverage_cell_degrees,
+                                 margin=config.coverage_margin_degrees)
+    print "FHRS establishments cover " + str(len(coverage)) + " grid cells"
 
-if config.use_xml_file is True:
-    print "Parsing OSM XML file"
-    result = osm.parse_xml_file('data/filtered.osm')
-    print "Writing OSM data to database"
-    osm.write_result_nodes_and_ways(result=result, connection=con, filter_ways=False)
+if config.use_pbf_file is True:
+    print "Reading PBF file and writing OSM data to database"
+    written = osm.write_elements(osm.iter_pbf_elements(config.input_pbf), connection=con,
+                                 upsert=upsert,
+                                 reject_filename=config.osm_reject_file,
+                                 coverage=coverage)
+elif config.use_xml_file is True:
+    # reuse node positions saved when the same file was last parsed
+    node_store = NodeLocationStore()
+    store_file = os.path.join(config.osm_node_store_dir, 'ids.npy')
+    if (config.osm_node_store_dir and os.path.exists(store_file) and
+            os.path.getmtime(store_file) > os.path.getmtime('data/filtered.osm')):
+        print "Loading OSM node positions from " + config.osm_node_store_dir
+        node_store.load(config.osm_node_store_dir)
+    print "Parsing OSM XML file and writing OSM data to database"
+    f = open('data/filtered.osm')
+    written = osm.write_elements(osm.iter_xml_elements(f), connection=con,
+                                 filter_ways=False, upsert=upsert,
+                                 node_store=node_store,
+                                 reject_filename=config.osm_reject_file,
+                                 coverage=coverage)
+    f.close()
+    if config.osm_node_store_dir and not node_store.read_only:
+        print "Saving " + str(len(node_store)) + " OSM node positions"
+        node_store.save(config.osm_node_store_dir)
 else:
-    # get OSM data within matching bounding box
-    print 'Calculating geographical extent of FHRS data, ignoring outliers'
-    fhrs_bbox = fhrs.get_corrected_bbox(connection=con)
-    print "Running Overpass query"
-    result = osm.run_overpass_query(bbox=fhrs_bbox)
-    if len(result.get_node_ids()) + len(result.get_way_ids()) < 1:
+    if coverage is not None:
+        # only query the rectangles of cells containing FHRS establishments
+        tiles = coverage.get_bboxes(tile_size=config.overpass_tile_degrees)
+    else:
+        # get OSM data within matching bounding box
+        print 'Calculating geographical extent of FHRS data, ignoring outliers'
+        fhrs_bbox = fhrs.get_corrected_bbox(connection=con)
+        tiles = osm.get_tiles(fhrs_bbox, tile_size=config.overpass_tile_degrees)
+    print "Running Overpass queries and writing OSM data to database"
+    elements = osm.iter_overpass_tiles(tiles=tiles, max_workers=config.overpass_threads,
+                                       center=config.overpass_center)
+    written = osm.write_elements(elements, connection=con,
+                                 filter_ways=False, upsert=upsert,
+                                 reject_filename=config.osm_reject_file,
+                                 coverage=coverage)
+    if written < 1:
         print "Overpass query result appears to be empty. Stopping."
         exit(1)
-    print "Writing OSM data to database"
-    osm.write_result_nodes_and_ways(result=result, connection=con, filter_ways=False)
+print "Wrote " + str(written) + " OSM entities"
@@ -4,4 +4,5 @@ source config.py
 
 shp2pgsql -d -s 27700:4326 -I shapefiles/district_borough_unitary_region.shp districts > temp.sql && \
 psql -d $dbname -f temp.sql && \
-rm temp.sql
+rm temp.sql && \
+python -c "from fhrs_osm import Database; db = Database('$dbname'); db.connect(); db.create_district_pieces()"
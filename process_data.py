@@ -4,16 +4,23 @@ import config
 db = Database(config.dbname)
 db.connect()
 
-# compute districts
-print "Adding district ID for FHRS establishments"
-db.add_fhrs_districts()
-print "Adding district ID for OSM entities"
-db.add_osm_districts()
+# compute districts, unless they were added when the data was written
+if config.tag_districts_on_ingest:
+    print "Indexing district IDs added when data was written"
+    db.create_district_index('fhrs_establishments')
+    db.create_district_index('osm')
+else:
+    print "Adding district ID for FHRS establishments"
+    db.add_fhrs_districts(max_workers=config.district_threads)
+    print "Adding district ID for OSM entities"
+    db.add_osm_districts(max_workers=config.district_threads)
 
 # create database views
 print "Creating database view for data comparison"
-db.create_comparison_view()
+db.create_comparison_view(materialised=config.materialise_views)
 print "Creating database view to suggest FHRS/OSM matches"
-db.create_suggest_matches_view()
+db.create_suggest_matches_view(materialised=config.materialise_views,
+                               candidate_limit=config.suggest_candidate_limit)
 print "Creating database view for distant matches"
-db.create_distant_matches_view(distance_metres=config.warning_distance_metres)
+db.create_distant_matches_view(distance_metres=config.warning_distance_metres,
+                               materialised=config.materialise_views)
@@ -12,11 +12,16 @@ source config.py
 pip install overpy || exit 1
 pip install psycopg2-binary || exit 1
 pip install shapely || exit 1
+pip install numpy || exit 1
 dropdb --if-exists $dbname || exit 1
 createdb $dbname || exit 1
-psql -d $dbname -c "create extension postgis; create extension fuzzystrmatch;" || exit 1
+psql -d $dbname -c "create extension postgis; create extension fuzzystrmatch; create extension pg_trgm;" || exit 1
 ./import_bline_districts.sh || exit 1
-if [[ $use_xml_file == True ]]
+if [[ $use_pbf_file == True ]]
+then
+	# pyosmium 3.0 and later need Python 3
+	pip install "osmium<3" || exit 1
+elif [[ $use_xml_file == True ]]
 then
 	./filter-osm.sh || exit 1
 fi